@@ -0,0 +1,39 @@
+"""
+Exports the detection model at `MODEL_PATH` for the TorchScript and ONNX Runtime engines.
+
+Run once per model, and again whenever the weights or `INFERENCE_SIZE` change (the model's resize is exported with it), e.g.
+
+    python -m app.export_model --engine onnx --quantize
+
+then start the app with `MODEL_ENGINE=onnx MODEL_QUANTIZE=true`. The artifacts are written next to the weights.
+`python -m benchmarks.inference_engines` compares their speed and predictions with the eager model.
+"""
+import argparse
+import time
+
+from app.server.config.config import MODEL_CLASSES, MODEL_PATH
+from app.server.logger.custom_logger import logger
+from app.server.static.enums import ModelEngine
+from app.server.utils.engine_utils import export_model
+
+EXPORTED_ENGINES = [ModelEngine.TORCHSCRIPT.value, ModelEngine.ONNX.value]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', choices=EXPORTED_ENGINES, action='append', help='Engine to export for, can be repeated, defaults to all of them')
+    parser.add_argument('--quantize', action='store_true', help='Quantize the fully connected layers to int8 as well')
+    parser.add_argument('--model-path', default=MODEL_PATH)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for engine in args.engine or EXPORTED_ENGINES:
+        start_time = time.time()
+        path = export_model(args.model_path, MODEL_CLASSES, engine, args.quantize)
+        logger.info(f'Exported {args.model_path} for {engine} to {path} in {time.time() - start_time:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Entry point of a model server, which runs the detector for processes started with `INFERENCE_BACKEND=remote`.
+
+Run with `python -m app.inference_server` (port `INFERENCE_SERVER_PORT`) and point the API and worker processes at it
+with `INFERENCE_SERVER_URL`. `create_app` serves any object with the `predict` of an inference backend, so tests and
+benchmarks can stand one up around a stub model instead of the real one.
+"""
+import asyncio
+
+import cv2
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, File, HTTPException, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from starlette.middleware.gzip import GZipMiddleware
+
+from app.server.config.config import INFERENCE_SERVER_PORT
+from app.server.logger.custom_logger import logger
+from app.server.utils.inference_utils import LocalInferenceBackend, to_json_prediction
+from app.server.utils.model_utils import model_loader
+
+
+def decode_frame(data: bytes):
+    frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Frame could not be decoded')
+    return frame
+
+
+def create_app(backend) -> FastAPI:
+    """Creates the model server app
+
+    Args:
+        backend: Runs the predictions, e.g. `LocalInferenceBackend`; warmed up at startup when it has `warm_up`
+    """
+    app = FastAPI(title='Capture Aerospace Inference Server', docs_url=None, redoc_url=None, openapi_url=None, default_response_class=ORJSONResponse)
+    # Predictions of a batch are a few KB of JSON, frames come in already compressed
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
+    app.state.ready = not hasattr(backend, 'warm_up')
+
+    @app.on_event('startup')
+    async def startup_event():
+        if not app.state.ready:
+            app.state.warm_up_task = asyncio.create_task(warm_up())
+
+    async def warm_up():
+        try:
+            await run_in_threadpool(backend.warm_up)
+            app.state.ready = True
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error(f'Model warm-up failed: {error}')
+
+    @app.get('/ready')
+    async def readiness():
+        if app.state.ready:
+            return {'status': 'READY'}
+        return ORJSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={'status': 'WARMING_UP'})
+
+    @app.post('/predict')
+    async def predict(frames: list[UploadFile] = File(...)):
+        """Runs the detector over a batch of encoded frames, predictions are in the order of the frames"""
+        data = [await frame.read() for frame in frames]
+        # Decoding and the forward pass both hold the CPU, neither runs on the event loop
+        predictions = await run_in_threadpool(lambda: backend.predict([decode_frame(frame) for frame in data]))
+        return {'predictions': [to_json_prediction(prediction) for prediction in predictions]}
+
+    return app
+
+
+app = create_app(LocalInferenceBackend(model_loader))
+
+
+if __name__ == '__main__':
+    uvicorn.run(app, host='0.0.0.0', port=INFERENCE_SERVER_PORT)
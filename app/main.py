@@ -1,35 +1,39 @@
-from fastapi import APIRouter, FastAPI
+import asyncio
+
+from fastapi import FastAPI, status
 from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import ORJSONResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from starlette.exceptions import HTTPException
 
+from app.server.config.config import APP_ROLE
 from app.server.handler.error_handler import http_exception_handler, validation_exception_handler
+from app.server.http_client.http_client import http_client_pool
+from app.server.jobs.job_poller import poll_parsed_videos, release_parsed_videos
+from app.server.jobs.job_queue import job_queue
 from app.server.logger.custom_logger import logger
 from app.server.middlewares.exceptions import ExceptionHandlerMiddleware
-from app.server.middlewares.request_gzip import GzipRoute
+from app.server.middlewares.response_gzip import SelectiveGZipMiddleware
 from app.server.routes.v1_api import v1_api_router as V1_API_ROUTER
+from app.server.static.enums import AppRole
 
-# from app.server.utils import date_utils, mongo_utils
-from app.server.utils import date_utils
+from app.server.utils import date_utils, mongo_utils
+from app.server.utils.inference_utils import inference_backend
+from app.server.utils.metrics_utils import render_metrics
 
 # Initialise the app
 app = FastAPI(
     docs_url=None, redoc_url=None, openapi_url=None, title='Capture Aerospace Backend', version='1.0.0', swagger_ui_parameters={'defaultModelsExpandDepth': -1}, default_response_class=ORJSONResponse
 )
 
-GZIP_REQUEST_ROUTE = APIRouter(route_class=GzipRoute)
-
 # add routes
-app.include_router(GZIP_REQUEST_ROUTE)
 app.include_router(V1_API_ROUTER, tags=['API version-v1'], prefix='/api/v1')
 
 # add middlewares
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1000)
 app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_credentials=True, allow_methods=['*'], allow_headers=['*'])
 
 # add exception handlers
@@ -61,17 +65,48 @@ app.mount('/media', StaticFiles(directory='app/media'), name='media')
 @app.on_event('startup')
 async def startup_event():
     logger.debug(f'App startup: {str(date_utils.get_current_datetime())}')
-    # await mongo_utils.create_indexes()
+    await mongo_utils.create_indexes()
+    await http_client_pool.start()
+    if APP_ROLE != AppRole.API:
+        await job_queue.start()
+        # Warm the model up in the background, /ready reports when it's done
+        app.state.background_tasks = [asyncio.create_task(warm_up_model()), asyncio.create_task(poll_parsed_videos())]
     # Count the number of APIs
     num_apis = len(app.routes)
     print(f'**********************************************\nThere are {num_apis} APIs in this application.\n**********************************************')
 
 
+async def warm_up_model():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, inference_backend.warm_up)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.error(f'Model warm-up failed: {error}')
+
+
 @app.on_event('shutdown')
-def shutdown_event():
+async def shutdown_event():
+    for task in getattr(app.state, 'background_tasks', []):
+        task.cancel()
+    if APP_ROLE != AppRole.API:
+        await release_parsed_videos(await job_queue.stop())
+    await http_client_pool.stop()
     logger.debug(f'App shutdown: {str(date_utils.get_current_datetime())}')
 
 
 @app.get('/', tags=['Root'], include_in_schema=False)
 async def read_root():
     return {'message': app.title}
+
+
+@app.get('/ready', tags=['Root'], include_in_schema=False)
+async def readiness():
+    # API-only processes never load the model, they're ready as soon as they serve requests
+    if APP_ROLE == AppRole.API or inference_backend.is_ready():
+        return {'status': 'READY'}
+    return ORJSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={'status': 'WARMING_UP'})
+
+
+@app.get('/metrics', tags=['Root'], include_in_schema=False)
+async def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
@@ -7,6 +7,78 @@ load_dotenv()
 # Logs
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
 LOG_FILE_NAME = os.environ.get('LOG_FILE_NAME', 'app')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text (coloured console and file sinks) or json (one JSON object per line on stdout, written in batches)
+LOG_REQUEST_SAMPLE_RATE = float(os.environ.get('LOG_REQUEST_SAMPLE_RATE', 1))  # Share (0-1) of successful requests that are logged, errors are always logged
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 256))  # JSON logs are written once this many records are waiting...
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 1))  # ...or this many seconds have passed
 
 # Mongo
 MONGO_URI = os.environ.get('MONGO_URI')
+
+# Process role: all (API and jobs), api (serves requests only, never loads the model) or worker (only processes videos)
+APP_ROLE = os.environ.get('APP_ROLE', 'all')
+
+# Jobs
+JOB_MAX_CONCURRENCY = int(os.environ.get('JOB_MAX_CONCURRENCY', 2))  # Number of videos processed at the same time
+JOB_QUEUE_MAX_SIZE = int(os.environ.get('JOB_QUEUE_MAX_SIZE', 100))  # Pending jobs beyond this are rejected with 503
+JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL', 2))  # Seconds between progress writes of a job, and between progress events sent to clients
+JOB_STOP_TIMEOUT = float(os.environ.get('JOB_STOP_TIMEOUT', 20))  # Seconds a stopping process waits for its running jobs to reach their next batch and stop
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2))  # Seconds a worker waits before looking for unclaimed videos again
+JOB_CLAIM_TIMEOUT = float(os.environ.get('JOB_CLAIM_TIMEOUT', 300))  # Seconds without a heartbeat after which a claimed video is taken over, e.g. from a killed process
+JOB_CPU_CORES = int(os.environ.get('JOB_CPU_CORES', 0))  # Cores split evenly between the running jobs, 0 for every core the process may run on
+
+# Outbound HTTP, one connection pool shared by every RestClient of the process
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20))  # Idle connections kept open for reuse
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_KEEPALIVE_EXPIRY', 30))  # Seconds an idle connection is kept open
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 240))  # Seconds, per read/write/pool wait
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))  # Extra attempts after a failed request, see RestClient for what's retried
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))  # Seconds before the first retry, doubled for every following one
+
+# Uploads
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 4 * 1024 * 1024 * 1024))  # bytes, larger uploads are rejected with 413
+MAX_DECOMPRESSED_REQUEST_SIZE = int(os.environ.get('MAX_DECOMPRESSED_REQUEST_SIZE', MAX_UPLOAD_SIZE))  # bytes, compressed request bodies that inflate beyond this are rejected with 413
+
+# Model
+MODEL_PATH = os.environ.get('MODEL_PATH', 'app/data/Train.pth')
+MODEL_CLASSES = os.environ.get('MODEL_CLASSES', '1,2,3,4,5').split(',')
+MODEL_ENGINE = os.environ.get('MODEL_ENGINE', 'eager')  # eager (detecto), torchscript or onnx, the last two run the artifacts of `python -m app.export_model`
+MODEL_QUANTIZE = os.environ.get('MODEL_QUANTIZE', 'false').lower() == 'true'  # dynamic int8 quantization of the fully connected layers
+
+# Inference
+INFERENCE_BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', 4))  # Frames run through the detector in a single forward pass
+DETECTION_MODE = os.environ.get('DETECTION_MODE', 'tracker')  # detector, tracker or strided, see static.enums.DetectionMode
+DETECTION_STRIDE = int(os.environ.get('DETECTION_STRIDE', 10))  # Strided mode runs the detector every this many frames
+SCENE_CHANGE_THRESHOLD = float(os.environ.get('SCENE_CHANGE_THRESHOLD', 0.15))  # Frame difference (0-1) that forces re-detection in strided mode
+MOTION_GATE_THRESHOLD = float(os.environ.get('MOTION_GATE_THRESHOLD', 0))  # Frame difference (0-1) below which detector mode reuses the last detections, 0 runs the detector on every frame
+MOTION_GATE_INTERVAL = int(os.environ.get('MOTION_GATE_INTERVAL', 30))  # Frames in a row that can reuse detections before the detector runs again regardless
+TRACKER_COUNT_FRAMES = int(os.environ.get('TRACKER_COUNT_FRAMES', 3))  # Frames the tracker mode detects on to count objects before tracking
+SCORE_FILTER = float(os.environ.get('SCORE_FILTER', 0.6))  # Minimum score of the boxes drawn on the video and stored
+INFERENCE_SIZE = int(os.environ.get('INFERENCE_SIZE', 800))  # Shorter side, in pixels, frames are downscaled to before detection (0 keeps full resolution)
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'local')  # local (the model runs in this process) or remote (frames are sent to INFERENCE_SERVER_URL)
+INFERENCE_SERVER_URL = os.environ.get('INFERENCE_SERVER_URL', 'http://localhost:8001')  # Model server started with `python -m app.inference_server`
+INFERENCE_FRAME_FORMAT = os.environ.get('INFERENCE_FRAME_FORMAT', 'jpeg')  # jpeg or png (lossless, larger), how frames are compressed before they're sent to the model server
+INFERENCE_JPEG_QUALITY = int(os.environ.get('INFERENCE_JPEG_QUALITY', 90))  # 0-100
+INFERENCE_SERVER_PORT = int(os.environ.get('INFERENCE_SERVER_PORT', 8001))
+
+# Video pipeline, frames each stage can hold before the previous one blocks
+PIPELINE_DECODE_QUEUE_DEPTH = int(os.environ.get('PIPELINE_DECODE_QUEUE_DEPTH', 16))
+PIPELINE_ANNOTATE_QUEUE_DEPTH = int(os.environ.get('PIPELINE_ANNOTATE_QUEUE_DEPTH', 8))
+PIPELINE_ENCODE_QUEUE_DEPTH = int(os.environ.get('PIPELINE_ENCODE_QUEUE_DEPTH', 16))
+
+# Output encoding
+ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'ffmpeg')  # opencv (DIVX through cv2.VideoWriter) or ffmpeg (H.264 through a pipe)
+ENCODER_PRESET = os.environ.get('ENCODER_PRESET', 'veryfast')  # x264 preset, slower presets give smaller files
+ENCODER_CRF = int(os.environ.get('ENCODER_CRF', 23))  # x264 constant rate factor, lower is better quality and larger files
+ENCODER_FRAGMENTED = os.environ.get('ENCODER_FRAGMENTED', 'false').lower() == 'true'  # fragmented MP4 instead of fast-start, playable while still being written
+HLS_PREVIEW = os.environ.get('HLS_PREVIEW', 'true').lower() == 'true'  # also write a live HLS preview while a job runs, ffmpeg backend only
+HLS_PREVIEW_KEEP = os.environ.get('HLS_PREVIEW_KEEP', 'false').lower() == 'true'  # keep the preview once the job is done, it's otherwise deleted as the final video holds the same frames
+HLS_SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', 2))  # length of the preview segments, and so roughly how far the preview lags
+
+# Trackers
+TRACKER_THREADS = int(os.environ.get('TRACKER_THREADS', os.cpu_count() or 1))  # Threads shared by all jobs to update the trackers of a frame concurrently
+
+# Segments, long videos are split at keyframes and the segments processed in parallel worker processes
+SEGMENT_WORKERS = int(os.environ.get('SEGMENT_WORKERS', 1))  # Worker processes, each with its own model; 1 processes videos in a single pass
+SEGMENT_MIN_FRAMES = int(os.environ.get('SEGMENT_MIN_FRAMES', 300))  # Videos aren't split into segments shorter than this
@@ -1,84 +1,170 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+
 import httpx
+import orjson
 from fastapi import HTTPException, status
 from fastapi.encoders import jsonable_encoder
 
+from app.server.config import config
+from app.server.logger.custom_logger import logger
+
+# Methods that can be sent again after the server may have seen them
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# Responses worth retrying, the server or a proxy in front of it is temporarily unable to answer
+RETRY_STATUS_CODES = {status.HTTP_502_BAD_GATEWAY, status.HTTP_503_SERVICE_UNAVAILABLE, status.HTTP_504_GATEWAY_TIMEOUT}
+# Errors raised before the request left this process, safe to retry whatever the method
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class HttpClientPool:
+    """
+    Owns the httpx.AsyncClient, and so the connection pool, shared by every RestClient of the process.
+
+    It's opened and closed with the app; a client asked for before `start` is created on first use
+    so scripts can use RestClient too, and is still closed by `stop`.
+    """
+
+    def __init__(self, limits: httpx.Limits, timeout: httpx.Timeout) -> None:
+        self.limits = limits
+        self.timeout = timeout
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self) -> None:
+        self.get()
+        logger.debug(f'HTTP client pool started with up to {self.limits.max_connections} connections')
+
+    async def stop(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.debug('HTTP client pool stopped')
+
+    def get(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self.client
+
 
 class RestClient:
-    def __init__(self, base_url: str = '', timeout: httpx.Timeout = None) -> None:
-        self.client = httpx.AsyncClient()
-        self.client.base_url = base_url
-        self.client.timeout = timeout
+    """
+    JSON client of one service, sending its requests through the shared connection pool.
+
+    Requests that fail to connect are retried whatever their method; idempotent requests are also retried on
+    other transport errors and on 502, 503 and 504 responses. Retries wait `retry_backoff` seconds, doubled every time.
+    A client can be given its own `pool`, for traffic that must not compete with the rest for connections.
+    """
+
+    def __init__(
+        self, base_url: str = '', timeout: httpx.Timeout = None, retries: int = config.HTTP_RETRIES, retry_backoff: float = config.HTTP_RETRY_BACKOFF, pool: Optional[HttpClientPool] = None
+    ) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.retry_backoff = retry_backoff
+        self.pool = pool
 
     @classmethod
-    def init(cls, base_url='', timeout=httpx.Timeout(240.0, connect=10.0)):
+    def init(cls, base_url='', timeout=httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT)):
         return cls(base_url, timeout)
 
     async def post(self, end_point: str, params, headers=None):
-        try:
-            response = await self.client.post(end_point, json=jsonable_encoder(params), headers=headers)
-            response = response.json()
-            return response
-        except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
-        except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+        return await self.request('POST', end_point, content=encode_json(params), headers=with_json_content_type(headers))
 
     async def post_encoded(self, end_point: str, params, headers=None):
-        try:
-            response = await self.client.post(end_point, params=params, headers=headers)
-            response = response.json()
-            return response
-        except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
-        except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+        return await self.request('POST', end_point, params=params, headers=headers)
 
     async def post_file(self, end_point: str, params=None, files=None, headers=None):
-        try:
-            response = await self.client.post(end_point, data=jsonable_encoder(params), files=files, headers=headers)
-            response = response.json()
-            return response
-        except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
-        except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+        return await self.request('POST', end_point, data=jsonable_encoder(params), files=files, headers=headers)
 
     async def get(self, end_point: str, params=None, headers=None):
-        try:
-            response = await self.client.get(end_point, params=jsonable_encoder(params), headers=headers)
-            response = response.json()
-            return response
-        except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
-        except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+        return await self.request('GET', end_point, params=jsonable_encoder(params), headers=headers)
 
     async def patch(self, end_point: str, params=None, headers=None):
-        try:
-            response = await self.client.patch(end_point, json=jsonable_encoder(params), headers=headers)
-            response = response.json()
-            return response
-        except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
-        except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+        return await self.request('PATCH', end_point, content=encode_json(params), headers=with_json_content_type(headers))
 
     async def put(self, end_point: str, params=None, headers=None):
+        return await self.request('PUT', end_point, content=encode_json(params), headers=with_json_content_type(headers))
+
+    async def delete(self, end_point: str, params=None, headers=None):
+        return await self.request('DELETE', end_point, params=jsonable_encoder(params), headers=headers)
+
+    async def request(self, method: str, end_point: str, **kwargs: Any):
+        """Sends a request, retrying as described on the class, and returns the decoded JSON response body"""
         try:
-            response = await self.client.put(end_point, json=jsonable_encoder(params), headers=headers)
-            response = response.json()
-            return response
+            response = await self._send(method, end_point, kwargs, stream=False)
+            return orjson.loads(response.content) if response.content else None
+        except HTTPException:
+            raise
         except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
         except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
 
-    async def delete(self, end_point: str, params=None, headers=None):
+    @asynccontextmanager
+    async def stream(self, method: str, end_point: str, **kwargs: Any) -> AsyncIterator[httpx.Response]:
+        """
+        Sends a request and yields the response before its body is read, for payloads too large to buffer
+
+        Only connecting is retried. Read the body with `response.aiter_bytes()`; the connection goes back
+        to the pool when the block exits.
+
+        Example:
+            async with client.stream('GET', '/export') as response:
+                async for chunk in response.aiter_bytes():
+                    ...
+        """
         try:
-            response = await self.client.delete(end_point, params=jsonable_encoder(params), headers=headers)
-            response = response.json()
-            return response
+            response = await self._send(method, end_point, kwargs, stream=True)
         except httpx.ConnectError as error:
-            raise HTTPException(statuc_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
-        except Exception as error:
-            raise HTTPException(statuc_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error)) from error
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{error.request.url.port} service unavailable') from error
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def _send(self, method: str, end_point: str, kwargs: dict[str, Any], stream: bool) -> httpx.Response:
+        client = (self.pool or http_client_pool).get()
+        request = client.build_request(method, self._get_url(end_point), timeout=self.timeout or httpx.USE_CLIENT_DEFAULT, **kwargs)
+        retry_any_error = method.upper() in IDEMPOTENT_METHODS and not stream
+        attempt = 0
+        while True:
+            last_attempt = attempt >= self.retries
+            try:
+                response = await client.send(request, stream=stream)
+            except CONNECT_ERRORS as error:
+                if last_attempt:
+                    raise
+                logger.debug(f'{method} {request.url} could not connect, retrying: {error}')
+            except httpx.TransportError as error:
+                if last_attempt or not retry_any_error:
+                    raise
+                logger.debug(f'{method} {request.url} failed, retrying: {error}')
+            else:
+                if last_attempt or not retry_any_error or response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                await response.aclose()
+                logger.debug(f'{method} {request.url} returned {response.status_code}, retrying')
+            await asyncio.sleep(self.retry_backoff * 2**attempt)
+            attempt += 1
+
+    def _get_url(self, end_point: str) -> str:
+        if not self.base_url or end_point.startswith(('http://', 'https://')):
+            return end_point
+        return f'{self.base_url}/{end_point.lstrip("/")}'
+
+
+def encode_json(params) -> bytes:
+    # orjson handles datetimes, UUIDs and dataclasses itself, jsonable_encoder is only the fallback for anything else (pydantic models)
+    return orjson.dumps(params, default=jsonable_encoder)
+
+
+def with_json_content_type(headers=None) -> dict[str, str]:
+    return {'Content-Type': 'application/json', **(headers or {})}
+
+
+http_client_pool = HttpClientPool(
+    httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS, max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY),
+    httpx.Timeout(config.HTTP_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+)
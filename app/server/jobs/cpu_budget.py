@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+from typing import Optional
+
+from app.server.config import config
+from app.server.logger.custom_logger import logger
+
+
+class CpuBudget:
+    """
+    Splits the node's cores evenly between the jobs running in the process.
+
+    The share is recomputed whenever a job starts or finishes, so a job running alone uses every core and two
+    running jobs use half each. torch and OpenCV only have one thread count per process, which every running
+    job shares. `torch.set_num_threads` also sets the OpenMP team size of the calling thread only, while threads
+    that already ran parallel work keep theirs, so every job thread applies the current share itself before each
+    batch (`apply_thread_budget`). Segment worker processes run one segment at a time and get a fixed count instead.
+    """
+
+    def __init__(self, cores: int) -> None:
+        self.cores = max(1, cores)
+        self.running_jobs = 0
+        self.fixed_threads: Optional[int] = None
+        self.cv2_threads: Optional[int] = None
+        self.applied = threading.local()
+
+    @property
+    def threads(self) -> int:
+        """Threads every running job currently gets"""
+        return self.fixed_threads or max(1, self.cores // max(1, self.running_jobs))
+
+    def set_running_jobs(self, running_jobs: int) -> None:
+        """Called by the job queue whenever a job starts or finishes"""
+        self.running_jobs = running_jobs
+        logger.debug(f'Splitting {self.cores} cores between {running_jobs} running jobs, {self.threads} threads each')
+
+    def set_threads(self, threads: int) -> None:
+        """Fixes the thread count of the process, for segment worker processes"""
+        self.fixed_threads = threads
+
+    def apply(self) -> None:
+        """Hands the current share to OpenCV and to torch for the calling thread, torch is imported with the model and never by the remote backend"""
+        threads = self.threads
+        if self.cv2_threads != threads:
+            import cv2  # pylint: disable=import-outside-toplevel
+
+            cv2.setNumThreads(threads)
+            self.cv2_threads = threads
+        torch = sys.modules.get('torch')
+        if torch is not None and getattr(self.applied, 'threads', None) != threads:
+            torch.set_num_threads(threads)
+            self.applied.threads = threads
+
+
+def apply_thread_budget() -> None:
+    """Called by the job threads before every batch, so they follow the share as other jobs start and finish"""
+    cpu_budget.apply()
+
+
+def get_cpu_cores() -> int:
+    """Cores this process may run on, which can be fewer than the machine has (CPU affinity, container cpusets)"""
+    if config.JOB_CPU_CORES > 0:
+        return config.JOB_CPU_CORES
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+cpu_budget = CpuBudget(get_cpu_cores())
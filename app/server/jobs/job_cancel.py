@@ -0,0 +1,18 @@
+import contextvars
+import threading
+from typing import Optional
+
+
+class JobCancelled(Exception):
+    """Raised in the threads of a job that was asked to stop, e.g. because the process is shutting down"""
+
+
+# Set by the job queue for the duration of every job, and copied into the threads the job runs its blocking work on
+cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar('cancel_event', default=None)
+
+
+def raise_if_cancelled() -> None:
+    """Raises JobCancelled once the current job's cancel event is set, checked before every batch of frames"""
+    event = cancel_event.get()
+    if event is not None and event.is_set():
+        raise JobCancelled()
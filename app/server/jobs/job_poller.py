@@ -0,0 +1,87 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Optional
+
+from bson import ObjectId
+
+from app.server.config.config import JOB_CLAIM_TIMEOUT, JOB_POLL_INTERVAL
+from app.server.config.databases import db
+from app.server.jobs.job_queue import job_queue
+from app.server.logger.custom_logger import logger
+from app.server.models.parsed_video import DetectionParams
+from app.server.static.enums import Status
+from app.server.utils.date_utils import get_current_datetime
+from app.server.utils.video_utils import detect_video_and_set_db
+
+parsed_video_collection = db.get_collection('parsed_videos')
+
+
+async def claim_parsed_video(entry_id: Optional[ObjectId] = None, claim_timeout: float = JOB_CLAIM_TIMEOUT):
+    """
+    Atomically marks the oldest unclaimed in-process video, or the one with `entry_id`, as claimed by this process
+
+    Videos whose claim wasn't refreshed for `claim_timeout` seconds are claimed too, their process is gone
+    (killed, out of memory) without handing them back. So are videos claimed before claims had a heartbeat.
+
+    Returns:
+        - The document as it was before it was claimed, or None when there is nothing to process
+    """
+    now = get_current_datetime()
+    expired = now - timedelta(seconds=claim_timeout)
+    query = {'status': Status.IN_PROCESS, '$or': [{'claimed': False}, {'claimedAt': None}, {'claimedAt': {'$lt': expired}}]}
+    if entry_id is not None:
+        query['_id'] = entry_id
+    entry = await parsed_video_collection.find_one_and_update(query, {'$set': {'claimed': True, 'claimedAt': now}}, sort=[('createdAt', 1)])
+    if entry and entry.get('claimed'):
+        logger.warning(f'Taking over video {entry["_id"]}, its claim expired (last heartbeat {entry.get("claimedAt")})')
+    return entry
+
+
+async def refresh_claims() -> None:
+    """Heartbeat of the videos queued or running in this process, so no other process takes them over"""
+    entry_ids = job_queue.get_job_ids()
+    if entry_ids:
+        await parsed_video_collection.update_many({'_id': {'$in': [ObjectId(entry_id) for entry_id in entry_ids]}, 'status': Status.IN_PROCESS}, {'$set': {'claimedAt': get_current_datetime()}})
+
+
+async def release_parsed_videos(entry_ids: list[str]) -> None:
+    """
+    Unclaims in-process videos this process won't finish, e.g. the jobs dropped by `job_queue.stop` on shutdown,
+    so a worker picks them up again instead of them staying in-process forever
+    """
+    if not entry_ids:
+        return
+    result = await parsed_video_collection.update_many(
+        {'_id': {'$in': [ObjectId(entry_id) for entry_id in entry_ids]}, 'status': Status.IN_PROCESS}, {'$set': {'claimed': False}, '$unset': {'progress': ''}}
+    )
+    logger.info(f'Released {result.modified_count} unfinished videos')
+
+
+async def poll_parsed_videos(poll_interval: float = JOB_POLL_INTERVAL) -> None:
+    """
+    Feeds videos waiting in Mongo into the local job queue, oldest first: those uploaded through API-only processes,
+    those uploaded while every worker was busy and those released by a process that shut down.
+
+    A video is only claimed when a worker is free, so videos stay in Mongo, where any worker process can take them,
+    rather than piling up in one process's queue. The claims of this process are refreshed a few times per
+    `JOB_CLAIM_TIMEOUT` along the way.
+    """
+    last_heartbeat = 0.0
+    while True:
+        if time.monotonic() - last_heartbeat >= JOB_CLAIM_TIMEOUT / 4:
+            try:
+                await refresh_claims()
+                last_heartbeat = time.monotonic()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error(f'Could not refresh the claimed videos: {error}')
+        try:
+            if job_queue.has_capacity():
+                entry = await claim_parsed_video()
+                if entry:
+                    entry_id = str(entry['_id'])
+                    job_queue.submit(entry_id, detect_video_and_set_db, entry_id, DetectionParams(**entry.get('detectionParams', {})))
+                    continue
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error(f'Could not claim a video: {error}')
+        await asyncio.sleep(poll_interval)
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+
+from bson import ObjectId
+
+from app.server.config.config import JOB_PROGRESS_INTERVAL
+from app.server.config.databases import db
+from app.server.jobs.cpu_budget import cpu_budget
+from app.server.logger.custom_logger import logger
+from app.server.models.parsed_video import JobProgress
+from app.server.utils.date_utils import get_current_datetime
+
+parsed_video_collection = db.get_collection('parsed_videos')
+
+
+class ProgressTracker:
+    """
+    Counts the frames a job has processed and periodically saves its progress on the parsed-video.
+
+    `update` is called from the detection threads for every batch of frames and only increments a counter.
+    A single task on the event loop writes the progress at most once every `interval` seconds, and only
+    when it changed, so Mongo sees one small write per interval however fast frames are processed.
+    The job's current share of the cores is saved with it.
+    """
+
+    def __init__(self, entry_id: str, total_frames: int, interval: float = JOB_PROGRESS_INTERVAL) -> None:
+        self.entry_id = entry_id
+        self.total_frames = total_frames
+        self.interval = interval
+        self.frames_done = 0
+        self.lock = threading.Lock()
+        self.last_frames = 0
+        self.last_time = time.time()
+        self.task = None
+
+    def update(self, frames: int) -> None:
+        """Adds processed frames, safe to call from any thread"""
+        with self.lock:
+            self.frames_done += frames
+
+    def snapshot(self) -> JobProgress:
+        """Progress since the job started, with the fps measured since the previous snapshot"""
+        with self.lock:
+            frames_done = self.frames_done
+        now = time.time()
+        elapsed = now - self.last_time
+        fps = (frames_done - self.last_frames) / elapsed if elapsed > 0 else 0
+        self.last_frames, self.last_time = frames_done, now
+        eta = max(0, self.total_frames - frames_done) / fps if fps > 0 else None
+        return JobProgress(framesDone=frames_done, totalFrames=self.total_frames, fps=round(fps, 2), eta=eta, cpuThreads=cpu_budget.threads, updatedAt=get_current_datetime())
+
+    async def start(self) -> None:
+        await self.write()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the periodic writes and saves the final count"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.write()
+
+    async def write(self) -> None:
+        await parsed_video_collection.update_one({'_id': ObjectId(self.entry_id)}, {'$set': {'progress': self.snapshot().dict()}})
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.frames_done == self.last_frames:
+                continue
+            try:
+                await self.write()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error(f'Could not save the progress of {self.entry_id}: {error}')
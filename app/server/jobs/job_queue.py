@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from collections.abc import Coroutine
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException, status
+
+from app.server.config import config
+from app.server.jobs.cpu_budget import cpu_budget
+from app.server.jobs.job_cancel import JobCancelled, cancel_event
+from app.server.logger.custom_logger import logger
+from app.server.utils.metrics_utils import Gauge
+
+
+class JobQueue:
+    """
+    In-process FIFO queue of background jobs served by a bounded pool of workers.
+
+    At most `max_concurrency` jobs run at once, each one getting a thread from a shared executor
+    for its blocking work. Jobs submitted while all workers are busy wait in the queue in arrival order.
+    Every running job has a cancel event, which its threads check between batches of frames (see `job_cancel`).
+    """
+
+    def __init__(self, max_concurrency: int, max_size: int) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_size = max_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.workers: list[asyncio.Task] = []
+        self.running: dict[str, threading.Event] = {}
+        self.waiting: set[str] = set()
+
+    async def start(self) -> None:
+        """Creates the executor and spawns the worker tasks on the running event loop"""
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='job-worker')
+        self.workers = [asyncio.create_task(self._worker(index)) for index in range(self.max_concurrency)]
+        logger.debug(f'Job queue started with {self.max_concurrency} workers')
+
+    async def stop(self, timeout: float = config.JOB_STOP_TIMEOUT) -> list[str]:
+        """
+        Drops pending jobs, cancels the running ones and waits up to `timeout` seconds for their threads to finish,
+        then cancels the workers and shuts down the executor
+
+        Returns:
+            - Ids of the jobs dropped from the queue or cancelled, for the caller to hand back. Jobs whose threads
+              were still running at the timeout are left out, as they may still write their files
+        """
+        dropped = []
+        while self.queue is not None and not self.queue.empty():
+            job_id, _, _ = self.queue.get_nowait()
+            self.queue.task_done()
+            self.waiting.discard(job_id)
+            dropped.append(job_id)
+        cancelled = list(self.running)
+        for event in self.running.values():
+            event.set()
+        deadline = time.monotonic() + timeout
+        while self.running and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.running:
+            logger.warning(f'Jobs {", ".join(self.running)} did not stop within {timeout}s')
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        dropped.extend(job_id for job_id in cancelled if job_id not in self.running)
+        logger.debug(f'Job queue stopped, dropping {len(dropped)} jobs')
+        return dropped
+
+    def check_accepting(self) -> None:
+        """Raises the 503 `submit` would raise when the queue isn't running or is full"""
+        if self.queue is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Job queue is not running')
+        if self.queue.full():
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Too many videos waiting to be processed, try again later')
+
+    def submit(self, job_id: str, job: Callable[..., Coroutine[Any, Any, Any]], *args: Any) -> int:
+        """
+        Appends a job to the end of the queue
+
+        Args:
+            job_id: Identifier of the job, used for logging
+            job: Coroutine function to run in a worker
+            args: Arguments passed to the job
+        Returns:
+            - Number of jobs that start before this one, 0 when a worker is free to start it right away
+        """
+        self.check_accepting()
+        self.queue.put_nowait((job_id, job, args))
+        self.waiting.add(job_id)
+        return max(0, self.queue.qsize() - (self.max_concurrency - len(self.running)))
+
+    def get_job_ids(self) -> list[str]:
+        """Ids of the jobs running or waiting in the queue"""
+        return list(self.running) + list(self.waiting)
+
+    def has_capacity(self) -> bool:
+        """Whether a new job would start right away instead of waiting behind others"""
+        return self.queue is not None and len(self.running) + self.queue.qsize() < self.max_concurrency
+
+    async def run_blocking(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Runs a blocking function on the job executor without blocking the event loop
+
+        The function runs in a copy of the caller's context, so its logs carry the job's context fields.
+        """
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(context.run, func, *args))
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job_id, job, args = await self.queue.get()
+            self.waiting.discard(job_id)
+            event = self.running[job_id] = threading.Event()
+            cpu_budget.set_running_jobs(len(self.running))
+            token = cancel_event.set(event)
+            try:
+                # Everything logged while the job runs carries its id
+                with logger.contextualize(job_id=job_id):
+                    logger.debug(f'Worker {index} started job {job_id}')
+                    await job(*args)
+                    logger.debug(f'Worker {index} finished job {job_id}')
+            except JobCancelled:
+                logger.info(f'Job {job_id} cancelled')
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error(f'Job {job_id} failed: {error}')
+            finally:
+                cancel_event.reset(token)
+                self.running.pop(job_id, None)
+                cpu_budget.set_running_jobs(len(self.running))
+                self.queue.task_done()
+
+
+job_queue = JobQueue(config.JOB_MAX_CONCURRENCY, config.JOB_QUEUE_MAX_SIZE)
+
+Gauge('capae_jobs_waiting', 'Jobs waiting in the job queue', function=lambda: job_queue.queue.qsize() if job_queue.queue else 0)
+Gauge('capae_jobs_running', 'Jobs currently running', function=lambda: len(job_queue.running))
@@ -1,28 +1,101 @@
+import atexit
+import queue
+import random
 import sys
+import threading
+import time
+import traceback
 
+import orjson
 from loguru import logger
 from starlette.requests import Request
-from starlette.responses import Response
 
 from app.server.config import config
+from app.server.static.constants import LOGGER_SERVICE_NAME
+from app.server.static.enums import LogFormat
 
 
-def logging_api_requests(request: Request, response: Response):
-    logs = f'{request.client.host}:{request.client.port} {request.method} {request.url} {response.status_code}'
-    # logs += '\n\n' + '*********Request Headers Start***********\n'
-    # logs += '\n'.join(f'{name} : {value}' for name, value in request.headers.items())
-    # logs += '\n' + '*********Request Headers End***********\n'
-    # logs += '\n\n' + '*********Response Headers Start***********\n'
-    # logs += '\n'.join(f'{name} : {value}' for name, value in response.headers.items())
-    # logs += '\n' + '*********Response Headers End***********\n'
-    logger.debug(logs)
+def logging_api_requests(request: Request, status_code: int):
+    # Successful requests are sampled, errors are always logged
+    if status_code < 400 and config.LOG_REQUEST_SAMPLE_RATE < 1 and random.random() >= config.LOG_REQUEST_SAMPLE_RATE:
+        return
+    client = request.scope.get('client') or ('-', '-')
+    # The message is only formatted when a sink takes DEBUG, and the keyword arguments become fields of JSON logs
+    logger.debug('{client}:{port} {method} {path} {status}', client=client[0], port=client[1], method=request.method, path=request.scope['path'], status=status_code)
+
+
+def serialize_record(record) -> bytes:
+    """Converts a loguru record to one JSON line, with its bound and contextual fields (job id, stage, ...) at the top level"""
+    entry = {
+        'time': record['time'].isoformat(),
+        'level': record['level'].name,
+        'message': record['message'],
+        'service': LOGGER_SERVICE_NAME,
+        'logger': record['name'],
+        'function': record['function'],
+        'line': record['line'],
+    }
+    entry.update(record['extra'])
+    if record['exception'] is not None:
+        entry['exception'] = ''.join(traceback.format_exception(*record['exception']))
+    return orjson.dumps(entry, default=str) + b'\n'
+
+
+class BatchedJsonSink:
+    """
+    Loguru sink that writes records as JSON lines from a background thread, in batches.
+
+    Logging calls only put the record on a queue; serializing and writing happen on the writer thread, which
+    writes once `batch_size` records are waiting or `flush_interval` seconds have passed, in a single write call.
+    """
+
+    def __init__(self, stream, batch_size: int, flush_interval: float) -> None:
+        self.stream = stream
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def __call__(self, message) -> None:
+        self.records.put(message.record)
+
+    def stop(self) -> None:
+        """Writes the records still waiting and stops the writer thread"""
+        self.records.put(None)
+        self.thread.join(timeout=5)
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                try:
+                    # Wait for the first record of a batch as long as it takes, the rest only until the batch is due
+                    record = self.records.get(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopped = True
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(serialize_record(record))
+            if batch:
+                self.stream.write(b''.join(batch))
+                self.stream.flush()
 
 
 SEPARATOR = '\n--------------------------------------------------------------------------\n'
 FORMAT = '{level} | {time:ddd MMMM YYYY, HH:mm:ss:SSS} | {name}:{function}:{line}' + SEPARATOR + '{message}' + SEPARATOR
 logger.remove()
-logger = logger.opt(colors=True)
-logger.add(sys.stdout, colorize=True, level=config.LOG_LEVEL, format=FORMAT, enqueue=True, backtrace=True)
+if LogFormat(config.LOG_FORMAT) == LogFormat.JSON:
+    logger.add(BatchedJsonSink(sys.stdout.buffer, config.LOG_BATCH_SIZE, config.LOG_FLUSH_INTERVAL), level=config.LOG_LEVEL, format='{message}', backtrace=False)
+else:
+    logger = logger.opt(colors=True)
+    logger.add(sys.stdout, colorize=True, level=config.LOG_LEVEL, format=FORMAT, enqueue=True, backtrace=True)
+    logger.add(f'logs/{config.LOG_FILE_NAME}.log', colorize=True, rotation='10 MB', level=config.LOG_LEVEL, format=FORMAT, enqueue=True, backtrace=True)
+    logger.add(sys.stderr, colorize=True, level='ERROR', format=FORMAT, enqueue=True, backtrace=True)
 logger.enable('logger')
-logger.add(f'logs/{config.LOG_FILE_NAME}.log', colorize=True, rotation='10 MB', level=config.LOG_LEVEL, format=FORMAT, enqueue=True, backtrace=True)
-logger.add(sys.stderr, colorize=True, level='ERROR', format=FORMAT, enqueue=True, backtrace=True)
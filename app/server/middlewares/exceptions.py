@@ -1,4 +1,3 @@
-import contextlib
 import time
 from typing import Any
 
@@ -6,43 +5,76 @@ from fastapi import HTTPException, Request, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from app.server.logger.custom_logger import logger, logging_api_requests
+from app.server.utils.metrics_utils import http_request_seconds
 
 
-class ExceptionHandlerMiddleware(BaseHTTPMiddleware):
-    """Middleware to handles exceptions in HTTP requests and responses."""
+class ExceptionHandlerMiddleware:
+    """
+    Maps exceptions in HTTP requests to JSON error responses, adds the process time header and logs every request.
+
+    It's a plain ASGI middleware: response messages go straight through to the server and only the start message
+    is touched, so streaming and large media responses are neither buffered nor run in an extra task.
+    """
 
-    async def dispatch(self, request: Request, call_next):
-        response = await handle_exceptions(request, call_next)
-        return response or await call_next(request)
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
 
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-async def handle_exceptions(request: Request, call_next) -> JSONResponse:
-    """Middleware to catch all the Exceptions and send API process time over response headers"""
-    try:
         start_time = time.time()
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        response.headers['X-Process-Time'] = str(process_time)
-        logging_api_requests(request, response)
-    except RequestValidationError as error:
+        response_started = False
+
+        async def send_with_process_time(message: Message) -> None:
+            nonlocal response_started
+            if message['type'] == 'http.response.start':
+                response_started = True
+                process_time = time.time() - start_time
+                MutableHeaders(scope=message).append('X-Process-Time', str(process_time))
+                request = Request(scope)
+                http_request_seconds.observe(process_time, request.method, get_route_label(request), str(message['status']))
+                logging_api_requests(request, message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_process_time)
+        except Exception as error:  # pylint: disable=broad-except
+            if response_started:
+                # The status line is already out, all that's left is to cut the response short
+                logger.error(f'Error while sending the response: {error}')
+                raise
+            response = get_exception_response(error)
+            await response(scope, receive, send_with_process_time)
+
+
+def get_exception_response(error: Exception) -> JSONResponse:
+    """Converts an exception raised while handling a request to the error response sent back"""
+    if isinstance(error, RequestValidationError):
         logger.debug(str(error))
-        response = JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content=get_error_response('Request validation error', status.HTTP_422_UNPROCESSABLE_ENTITY, error.errors()))
-    except ValueError as error:
+        return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content=get_error_response('Request validation error', status.HTTP_422_UNPROCESSABLE_ENTITY, error.errors()))
+    if isinstance(error, ValueError):
         logger.debug(str(error))
-        response = JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content=get_error_response(str(error), status.HTTP_422_UNPROCESSABLE_ENTITY))
-    except HTTPException as error:
+        return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content=get_error_response(str(error), status.HTTP_422_UNPROCESSABLE_ENTITY))
+    if isinstance(error, HTTPException):
         logger.debug(str(error.detail))
-        headers = {}
-        with contextlib.suppress(AttributeError):
-            headers = error.headers
-        response = JSONResponse(status_code=error.status_code, content=get_error_response(str(error.detail), error.status_code), headers=headers)
-    except Exception as error:  # pylint: disable=broad-except
-        logger.debug(str(error))
-        response = JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=get_error_response(str(error), status.HTTP_500_INTERNAL_SERVER_ERROR))
-    return response
+        return JSONResponse(status_code=error.status_code, content=get_error_response(str(error.detail), error.status_code), headers=getattr(error, 'headers', None))
+    logger.debug(str(error))
+    return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=get_error_response(str(error), status.HTTP_500_INTERNAL_SERVER_ERROR))
+
+
+def get_route_label(request: Request) -> str:
+    """Path template of the matched route, so ids in paths don't create a metric series per entry"""
+    route = request.scope.get('route')
+    if route is not None:
+        return route.path
+    # Mounted apps, like /media, only leave their mount path behind
+    return request.scope.get('root_path') or 'unmatched'
 
 
 def get_error_response(message: str, code: int, detail: Any = None) -> dict[str, Any]:
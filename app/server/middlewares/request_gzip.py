@@ -1,27 +1,149 @@
-import gzip
-from collections.abc import Coroutine
+import zlib
+from collections.abc import AsyncGenerator, Coroutine, Iterator
 from typing import Any, Callable
 
-from fastapi import Request, Response
+from fastapi import HTTPException, Request, Response, status
 from fastapi.routing import APIRoute
 
+from app.server.config.config import MAX_DECOMPRESSED_REQUEST_SIZE
+from app.server.static.constants import COMPRESSED_SLICE_SIZE, DECOMPRESSED_CHUNK_SIZE
 
-class GzipRequest(Request):
-    async def body(self) -> bytes:
-        if not hasattr(self, '_body'):
-            body = await super().body()
-            if 'gzip' in self.headers.getlist('Content-Encoding'):
-                body = gzip.decompress(body)
-            self._body = body  # pylint: disable=attribute-defined-outside-init
-        return self._body
 
+class ZlibDecoder:
+    """Inflates gzip or deflate data, at most `DECOMPRESSED_CHUNK_SIZE` bytes at a time
 
-class GzipRoute(APIRoute):
+    With `multi_member`, data following the end of a stream is inflated as the next stream, as gzip allows
+    a body made of several concatenated members.
+    """
+
+    def __init__(self, wbits: int, multi_member: bool = False) -> None:
+        self.wbits = wbits
+        self.multi_member = multi_member
+        self.decompressor = zlib.decompressobj(wbits)
+
+    def decode(self, data: bytes) -> Iterator[bytes]:
+        while data:
+            try:
+                chunk = self.decompressor.decompress(data, DECOMPRESSED_CHUNK_SIZE)
+            except zlib.error as error:
+                raise get_invalid_body_error() from error
+            if chunk:
+                yield chunk
+            data = self.decompressor.unconsumed_tail
+            if self.multi_member and self.decompressor.eof:
+                # Input past the end of a member starts the next one
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(self.wbits)
+
+    def flush(self) -> bytes:
+        try:
+            return self.decompressor.flush()
+        except zlib.error as error:
+            raise get_invalid_body_error() from error
+
+
+class SlicedDecoder:
+    """
+    Decompresses brotli or zstd data `COMPRESSED_SLICE_SIZE` input bytes at a time.
+
+    Neither library can cap how much one call returns, so the input is fed in small slices instead,
+    letting the size check run before a single call can inflate to something huge.
+    """
+
+    def __init__(self, decompress: Callable[[bytes], bytes]) -> None:
+        self.decompress = decompress
+
+    def decode(self, data: bytes) -> Iterator[bytes]:
+        for offset in range(0, len(data), COMPRESSED_SLICE_SIZE):
+            try:
+                chunk = self.decompress(data[offset : offset + COMPRESSED_SLICE_SIZE])
+            except Exception as error:  # pylint: disable=broad-except
+                # brotli and zstandard each raise their own error type for corrupt data
+                raise get_invalid_body_error() from error
+            if chunk:
+                yield chunk
+
+    def flush(self) -> bytes:
+        return b''
+
+
+def get_invalid_body_error() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Request body could not be decompressed')
+
+
+def get_too_large_error() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail='Decompressed request body is too large')
+
+
+def create_decoder(encoding: str):
+    """Creates the decoder of one Content-Encoding, brotli and zstd need their optional packages"""
+    if encoding in ('gzip', 'x-gzip'):
+        return ZlibDecoder(16 + zlib.MAX_WBITS, multi_member=True)
+    if encoding == 'deflate':
+        return ZlibDecoder(zlib.MAX_WBITS)
+    try:
+        if encoding == 'br':
+            import brotli  # pylint: disable=import-outside-toplevel
+
+            return SlicedDecoder(brotli.Decompressor().process)
+        if encoding == 'zstd':
+            import zstandard  # pylint: disable=import-outside-toplevel
+
+            return SlicedDecoder(zstandard.ZstdDecompressor().decompressobj().decompress)
+    except ImportError:
+        pass
+    raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=f'Unsupported Content-Encoding: {encoding}')
+
+
+def decode_chunks(decoders: list, chunk: bytes) -> Iterator[bytes]:
+    """Runs a chunk through the decoders in order, the output of each one being the input of the next"""
+    if not decoders:
+        yield chunk
+        return
+    for decoded in decoders[0].decode(chunk):
+        yield from decode_chunks(decoders[1:], decoded)
+
+
+class DecompressingRequest(Request):
+    """
+    Request whose body is decompressed as it streams in, according to its Content-Encoding.
+
+    Nothing is held beyond the chunk being decoded, so multipart uploads and JSON bodies see the decompressed
+    stream, and a body inflating beyond `MAX_DECOMPRESSED_REQUEST_SIZE` is rejected before it's fully read.
+    """
+
+    async def stream(self) -> AsyncGenerator[bytes, None]:
+        encodings = [encoding.strip().lower() for value in self.headers.getlist('Content-Encoding') for encoding in value.split(',')]
+        encodings = [encoding for encoding in encodings if encoding and encoding != 'identity']
+        if hasattr(self, '_body') or not encodings:
+            async for chunk in super().stream():
+                yield chunk
+            return
+
+        # Encodings are listed in the order they were applied, so they're undone from the last one
+        decoders = [create_decoder(encoding) for encoding in reversed(encodings)]
+        size = 0
+        async for chunk in super().stream():
+            for decoded in decode_chunks(decoders, chunk):
+                size += len(decoded)
+                if size > MAX_DECOMPRESSED_REQUEST_SIZE:
+                    raise get_too_large_error()
+                yield decoded
+        # Whatever the decoders still buffer, passed on through the decoders after them
+        for index, decoder in enumerate(decoders):
+            for decoded in decode_chunks(decoders[index + 1 :], decoder.flush()):
+                size += len(decoded)
+                if size > MAX_DECOMPRESSED_REQUEST_SIZE:
+                    raise get_too_large_error()
+                yield decoded
+
+
+class DecompressingRoute(APIRoute):
     def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
         original_route_handler = super().get_route_handler()
 
         async def custom_route_handler(request: Request) -> Response:
-            request = GzipRequest(request.scope, request.receive)
+            request = DecompressingRequest(request.scope, request.receive)
             return await original_route_handler(request)
 
         return custom_route_handler
@@ -0,0 +1,34 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+from app.server.static.constants import UNCOMPRESSIBLE_MEDIA_TYPES
+
+
+def is_uncompressible(content_type: str) -> bool:
+    return content_type.lower().startswith(UNCOMPRESSIBLE_MEDIA_TYPES)
+
+
+class SelectiveGZipResponder(GZipResponder):
+    """Passes responses of `UNCOMPRESSIBLE_MEDIA_TYPES` through untouched, like responses that already have a Content-Encoding"""
+
+    async def send_with_gzip(self, message: Message) -> None:
+        await super().send_with_gzip(message)
+        if message['type'] == 'http.response.start' and is_uncompressible(Headers(raw=message['headers']).get('content-type', '')):
+            self.content_encoding_set = True
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that skips videos, images, archives and event streams.
+
+    Gzip can't shrink media that is already compressed, and it would hold server-sent events back until
+    enough of them fill its buffer, so those are sent as they are.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and 'gzip' in Headers(scope=scope).get('Accept-Encoding', ''):
+            responder = SelectiveGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
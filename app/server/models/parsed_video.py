@@ -1,8 +1,73 @@
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 
-from app.server.static.enums import Status
+from app.server.config.config import (
+    DETECTION_MODE,
+    DETECTION_STRIDE,
+    INFERENCE_SIZE,
+    MODEL_ENGINE,
+    MODEL_PATH,
+    MODEL_QUANTIZE,
+    MOTION_GATE_INTERVAL,
+    MOTION_GATE_THRESHOLD,
+    SCENE_CHANGE_THRESHOLD,
+    SCORE_FILTER,
+    TRACKER_COUNT_FRAMES,
+)
+from app.server.static.enums import DetectionMode, ModelEngine, Status
+
+
+class DetectionParams(BaseModel):
+    """
+    Parameters a parsed-video was (or will be) processed with
+    """
+
+    mode: DetectionMode = DetectionMode(DETECTION_MODE)
+    stride: int = Field(DETECTION_STRIDE, ge=1)
+    sceneChangeThreshold: float = Field(SCENE_CHANGE_THRESHOLD, ge=0, le=1)
+    motionThreshold: float = Field(MOTION_GATE_THRESHOLD, ge=0, le=1)  # detector mode only, 0 runs the detector on every frame
+    motionInterval: int = Field(MOTION_GATE_INTERVAL, ge=1)
+
+
+class DetectionSettings(BaseModel):
+    """
+    Settings of the node that processed a parsed-video which change its output, a result is only reused under the same ones
+    """
+
+    modelPath: str = MODEL_PATH
+    modelEngine: ModelEngine = ModelEngine(MODEL_ENGINE)
+    modelQuantize: bool = MODEL_QUANTIZE
+    inferenceSize: int = INFERENCE_SIZE
+    trackerCountFrames: int = TRACKER_COUNT_FRAMES
+    scoreFilter: float = SCORE_FILTER
+
+
+class DetectionStats(BaseModel):
+    """
+    How many frames of a parsed-video went through the detector, how many were only tracked and how many reused the boxes of an earlier frame
+    """
+
+    totalFrames: int = 0
+    detectorFrames: int = 0
+    trackerFrames: int = 0
+    reusedFrames: int = 0
+    detectorRatio: float = 0
+    trackerRatio: float = 0
+    reusedRatio: float = 0
+
+
+class JobProgress(BaseModel):
+    """
+    Progress of a parsed-video that is still being processed
+    """
+
+    framesDone: int = 0
+    totalFrames: int = 0
+    fps: float = 0  # frames processed per second since the previous update
+    eta: Optional[float] = None  # seconds left at the current fps
+    cpuThreads: Optional[int] = None  # threads the job currently runs its model with, its share of the node's cores
+    updatedAt: datetime
 
 
 class ParsedVideo(BaseModel):
@@ -13,6 +78,14 @@ class ParsedVideo(BaseModel):
     name: str
     status: Status = Status.IN_PROCESS  # in-process, done, error
     runtime: Optional[str] = None
+    detectionParams: DetectionParams = Field(default_factory=DetectionParams)
+    detectionSettings: Optional[DetectionSettings] = None  # set when the video is done
+    stats: Optional[DetectionStats] = None
+    progress: Optional[JobProgress] = None
+    claimed: bool = False  # set once a process has taken the video off the queue
+    claimedAt: Optional[datetime] = None  # refreshed by the claiming process while the video is queued or running there
+    contentHash: Optional[str] = None  # SHA-256 of the uploaded file
+    resultOf: Optional[str] = None  # id of the parsed-video whose media folder holds this one's output, when the result was reused
     createdAt: datetime
 
 
@@ -22,6 +95,8 @@ class UpdateOutputVideoSuccess(BaseModel):
     """
 
     runtime: str
+    stats: Optional[DetectionStats] = None
+    detectionSettings: Optional[DetectionSettings] = None
     status: Status = Status.DONE
 
 
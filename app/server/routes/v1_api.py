@@ -1,11 +1,15 @@
-from typing import Any
+from typing import Any, Optional
 
-from fastapi import APIRouter, Request, UploadFile, Form
+from fastapi import APIRouter, Request, UploadFile, Form, Query
+from fastapi.responses import StreamingResponse
 
+from app.server.middlewares.request_gzip import DecompressingRoute
 from app.server.services import v1_api
+from app.server.static.constants import MAX_PARSED_VIDEOS_PAGE_SIZE, PARSED_VIDEOS_PAGE_SIZE
+from app.server.static.enums import DetectionMode, Status
 
-# Create the router
-v1_api_router = APIRouter()
+# Create the router, request bodies are decompressed as they stream in
+v1_api_router = APIRouter(route_class=DecompressingRoute)
 
 
 @v1_api_router.get('/temporary', summary='A temporary route to test the backend')
@@ -15,12 +19,38 @@ async def temporary(name: str, request: Request) -> dict[str, Any]:
 
 
 @v1_api_router.post('/upload-video', summary='Saves and processes the video file')
-async def process_video_route(video_file: UploadFile, request: Request, name: str = Form(...)) -> dict[str, Any]:
-    res_data = await v1_api.process_video(name, video_file, request)
+async def process_video_route(
+    video_file: UploadFile,
+    request: Request,
+    name: str = Form(...),
+    detection_mode: Optional[DetectionMode] = Form(None),
+    detection_stride: Optional[int] = Form(None),
+    scene_change_threshold: Optional[float] = Form(None),
+    motion_threshold: Optional[float] = Form(None),
+    motion_interval: Optional[int] = Form(None),
+) -> dict[str, Any]:
+    detection_params = {'mode': detection_mode, 'stride': detection_stride, 'sceneChangeThreshold': scene_change_threshold, 'motionThreshold': motion_threshold, 'motionInterval': motion_interval}
+    res_data = await v1_api.process_video(name, video_file, detection_params, request)
     return {'status': 'SUCCESS', 'data': res_data}
 
 
-@v1_api_router.get('/parsed-videos', summary='Returns all the parsed videos saved in the database')
-async def get_parsed_videos_route(request: Request) -> dict[str, Any]:
-    res_data = await v1_api.get_parsed_videos(request)
+@v1_api_router.get('/parsed-videos', summary='Returns a page of the parsed videos saved in the database, newest first')
+async def get_parsed_videos_route(
+    request: Request, limit: int = Query(PARSED_VIDEOS_PAGE_SIZE, ge=1, le=MAX_PARSED_VIDEOS_PAGE_SIZE), cursor: Optional[str] = None, status: Optional[Status] = None, fields: Optional[str] = None
+) -> dict[str, Any]:
+    res_data = await v1_api.get_parsed_videos(limit, cursor, status, fields, request)
     return {'status': 'SUCCESS', 'data': res_data}
+
+
+@v1_api_router.get('/parsed-videos/{entry_id}/detections', summary='Returns the boxes detected in a range of frames of a parsed video')
+async def get_detections_route(
+    entry_id: str, request: Request, start_frame: Optional[int] = None, end_frame: Optional[int] = None, start_time: Optional[float] = None, end_time: Optional[float] = None
+) -> dict[str, Any]:
+    res_data = await v1_api.get_detections(entry_id, start_frame, end_frame, start_time, end_time, request)
+    return {'status': 'SUCCESS', 'data': res_data}
+
+
+@v1_api_router.get('/parsed-videos/{entry_id}/progress', summary='Streams the progress of a parsed video as server-sent events')
+async def stream_progress_route(entry_id: str, request: Request) -> StreamingResponse:
+    events = await v1_api.get_progress_events(entry_id, request)
+    return StreamingResponse(events, media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -1,16 +1,34 @@
+import asyncio
+import math
 import os
-import shutil
+from typing import Any, Optional
 
-from fastapi import Request, UploadFile
+import orjson
+from bson import ObjectId
+from fastapi import HTTPException, Request, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
 
+from app.server.config.config import APP_ROLE, HLS_PREVIEW, JOB_PROGRESS_INTERVAL, SEGMENT_WORKERS
+from app.server.jobs.job_poller import claim_parsed_video
+from app.server.jobs.job_queue import job_queue
 from app.server.utils.video_utils import detect_video_and_set_db
-from app.server.utils.date_utils import get_current_datetime
-from app.server.static.constants import MEDIA_PATH, INPUT_FILE_PATH
+from app.server.utils.date_utils import get_current_datetime, get_formatted_time
+from app.server.utils.detection_utils import DetectionReader
+from app.server.utils.file_utils import get_temp_file_path, save_upload_file
+from app.server.utils.json_utils import filter_none
+from app.server.utils.mongo_utils import encode_cursor, get_keyset_query
+from app.server.static.constants import MEDIA_PATH, INPUT_FILE_PATH, DETECTIONS_FOLDER_PATH, MAX_DETECTION_QUERY_FRAMES, PREVIEW_FOLDER_PATH, PREVIEW_PLAYLIST_PATH, UPLOADS_PATH
 from app.server.config.databases import db
-from app.server.models.parsed_video import ParsedVideo
+from app.server.models.parsed_video import DetectionParams, DetectionSettings, ParsedVideo, UpdateOutputVideoError
+from app.server.static.enums import AppRole, Status
 
 parsed_video_collection = db.get_collection('parsed_videos')
 
+# Fields sent in progress events, the rest of the document isn't read
+PROGRESS_PROJECTION = {'status': 1, 'runtime': 1, 'progress': 1, 'stats': 1}
+# Fields of every listed parsed video whatever `fields` asks for, the cursor of the next page is made of them
+CURSOR_FIELDS = {'_id', 'createdAt'}
+
 
 async def temporary(name: str, request: Request):
     """
@@ -25,38 +43,205 @@ async def temporary(name: str, request: Request):
     return {}
 
 
-async def process_video(name: str, video_file: UploadFile, request: Request):
+async def process_video(name: str, video_file: UploadFile, detection_params: dict[str, Any], request: Request):
+    """
+    Saves the uploaded video and queues it for detection in the background.
+    When the same file was already processed with the same parameters and settings, the new entry reuses that result instead.
+
+    Args:
+        name: Name given to the video by the user
+        video_file: The uploaded video file
+        detection_params: Per-job overrides of the configured detection parameters, None values are ignored
+    Returns:
+        - JSON Data with the id of the parsed-video entry, which stays in-process until the job finishes
+    """
     current_datetime = get_current_datetime()
-    # create the mongodb entry
-    new_video = ParsedVideo(name=name, createdAt=current_datetime)
-    created_entry = await parsed_video_collection.insert_one(new_video.dict())
-    created_id = str(created_entry.inserted_id)
-    new_folder_path = os.path.join('app/', MEDIA_PATH, created_id)
+    params = DetectionParams(**filter_none(detection_params))
+
+    # stream the input video outside the media folder, validating, capping and hashing it while it's written
+    uploads_folder_path = os.path.join('app/', UPLOADS_PATH)
+    os.makedirs(uploads_folder_path, exist_ok=True)
+    upload_path = get_temp_file_path(uploads_folder_path, video_file.filename or '')
+    try:
+        content_hash = await save_upload_file(video_file, upload_path)
+
+        cached_entry = await find_cached_result(content_hash, params)
+        if cached_entry:
+            # point the new entry at the earlier result and skip detection altogether
+            result_of = cached_entry.get('resultOf') or str(cached_entry['_id'])
+            new_video = ParsedVideo(
+                name=name,
+                status=Status.DONE,
+                runtime=get_formatted_time(0),
+                detectionParams=params,
+                detectionSettings=cached_entry.get('detectionSettings'),
+                stats=cached_entry.get('stats'),
+                claimed=True,
+                contentHash=content_hash,
+                resultOf=result_of,
+                createdAt=current_datetime,
+            )
+            created_entry = await parsed_video_collection.insert_one(new_video.dict())
+            return {'id': str(created_entry.inserted_id), 'status': Status.DONE, 'filename': video_file.filename, 'resultOf': result_of}
+
+        # Processes that run jobs queue the video themselves, and turn it away while their queue is full
+        run_locally = APP_ROLE != AppRole.API
+        if run_locally:
+            job_queue.check_accepting()
+
+        # create the mongodb entry, unclaimed until a process queues it
+        new_video = ParsedVideo(name=name, detectionParams=params, contentHash=content_hash, createdAt=current_datetime)
+        created_entry = await parsed_video_collection.insert_one(new_video.dict())
+        created_id = str(created_entry.inserted_id)
+        new_folder_path = os.path.join('app/', MEDIA_PATH, created_id)
 
-    os.makedirs(new_folder_path, exist_ok=True)
-    new_video_path = os.path.join(new_folder_path, INPUT_FILE_PATH)
+        # move the input video into the folder named after the entry id
+        os.makedirs(new_folder_path, exist_ok=True)
+        os.replace(upload_path, os.path.join(new_folder_path, INPUT_FILE_PATH))
+    finally:
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
 
-    # save the input video in the folder with uuid
-    with open(new_video_path, 'wb') as buffer:
-        shutil.copyfileobj(video_file.file, buffer)
+    queue_position = None
+    # The claim's heartbeat and the release on shutdown keep a queued video from being lost when this process stops
+    if run_locally and await claim_parsed_video(created_entry.inserted_id):
+        try:
+            queue_position = job_queue.submit(created_id, detect_video_and_set_db, created_id, params)
+        except HTTPException:
+            await parsed_video_collection.update_one({'_id': created_entry.inserted_id}, {'$set': UpdateOutputVideoError().dict()})
+            raise
 
-    await detect_video_and_set_db(created_id)
+    response = {'id': created_id, 'status': Status.IN_PROCESS, 'filename': video_file.filename, 'queuePosition': queue_position}
+    if HLS_PREVIEW and SEGMENT_WORKERS <= 1:
+        # annotated segments show up here, through the /media mount, as soon as they're encoded
+        response['preview'] = '/' + os.path.join(MEDIA_PATH, created_id, PREVIEW_FOLDER_PATH, PREVIEW_PLAYLIST_PATH)
+    return response
 
-    return {'filename': video_file.filename}
 
+async def find_cached_result(content_hash: str, params: DetectionParams):
+    """
+    Finds a finished parsed-video of the same file processed with the same detection parameters, by a node with the
+    same output-affecting settings as this one's (model, engine, inference size, score filter...)
+
+    Args:
+        content_hash: SHA-256 of the uploaded file
+        params: Detection parameters of the new upload
+    Returns:
+        - The matching document, or None
+    """
+    query = {'contentHash': content_hash, 'status': Status.DONE}
+    query.update({f'detectionParams.{key}': value for key, value in params.dict().items()})
+    # results saved before the settings were recorded have none and are never reused
+    query.update({f'detectionSettings.{key}': value for key, value in DetectionSettings().dict().items()})
+    return await parsed_video_collection.find_one(query)
 
-async def get_parsed_videos(request: Request):
+
+async def get_progress_events(entry_id: str, request: Request):
     """
-    Fetches and returns all the parsed videos saved in the db
+    Checks that the parsed-video exists and returns a stream of its progress as server-sent events
 
-    Args: None
+    Args:
+        entry_id: The id of the parsed-video
+        request: A request object, used to stop streaming once the client disconnects
     Returns:
-        - Required JSON Data
+        - Async generator of SSE messages, a `progress` event whenever the progress changes and a final `end` event
+    """
+    if not ObjectId.is_valid(entry_id) or not await parsed_video_collection.find_one({'_id': ObjectId(entry_id)}, PROGRESS_PROJECTION):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Entry with the given id not found')
+    return stream_progress_events(entry_id, request)
+
+
+async def stream_progress_events(entry_id: str, request: Request):
+    """Polls one parsed-video for progress changes until it's no longer in-process or the client goes away"""
+    last_event = None
+    while not await request.is_disconnected():
+        document = await parsed_video_collection.find_one({'_id': ObjectId(entry_id)}, PROGRESS_PROJECTION)
+        if document is None:
+            return
+        document['_id'] = str(document['_id'])
+        event = orjson.dumps(document).decode()
+        if document.get('status') != Status.IN_PROCESS:
+            yield f'event: end\ndata: {event}\n\n'
+            return
+        # a comment line keeps proxies from closing an idle stream
+        yield f'event: progress\ndata: {event}\n\n' if event != last_event else ': keep-alive\n\n'
+        last_event = event
+        await asyncio.sleep(JOB_PROGRESS_INTERVAL)
+
+
+async def get_detections(entry_id: str, start_frame: Optional[int], end_frame: Optional[int], start_time: Optional[float], end_time: Optional[float], request: Request):
+    """
+    Returns the boxes stored for a range of frames of a parsed video, given either as frame indices or as seconds
+
+    Args:
+        entry_id: The id of the parsed-video
+        start_frame: First frame of the range, inclusive
+        end_frame: Last frame of the range, exclusive
+        start_time: Start of the range in seconds, used when `start_frame` isn't given
+        end_time: End of the range in seconds, used when `end_frame` isn't given
+    Returns:
+        - JSON Data with the frame range and one entry per box, with its frame, time, label, score, box and source
+    """
+    entry = await parsed_video_collection.find_one({'_id': ObjectId(entry_id)}, {'resultOf': 1}) if ObjectId.is_valid(entry_id) else None
+    if entry is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Entry with the given id not found')
+
+    # entries reusing an earlier result read that entry's store
+    detections_folder = os.path.join('app/', MEDIA_PATH, entry.get('resultOf') or entry_id, DETECTIONS_FOLDER_PATH)
+    try:
+        reader = await run_in_threadpool(DetectionReader, detections_folder)
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Detections of this video are not available yet') from error
+
+    if start_frame is None:
+        start_frame = math.floor(start_time * reader.fps) if start_time is not None else 0
+    if end_frame is None:
+        # A range starting past the last frame is empty, like the ranges `DetectionReader.query` clamps
+        end_frame = math.ceil(end_time * reader.fps) if end_time is not None else max(start_frame, min(reader.frame_count, start_frame + MAX_DETECTION_QUERY_FRAMES))
+    if start_frame < 0 or end_frame < start_frame:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Invalid frame range')
+    if end_frame - start_frame > MAX_DETECTION_QUERY_FRAMES:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f'At most {MAX_DETECTION_QUERY_FRAMES} frames can be queried at once')
+
+    detections = await run_in_threadpool(reader.query, start_frame, end_frame)
+    return {'startFrame': start_frame, 'endFrame': end_frame, 'fps': reader.fps, 'frameCount': reader.frame_count, 'detections': detections}
+
+
+async def get_parsed_videos(limit: int, cursor: Optional[str], video_status: Optional[Status], fields: Optional[str], request: Request):
+    """
+    Fetches one page of the parsed videos saved in the db, newest first
+
+    Args:
+        limit: Maximum number of parsed videos in the page
+        cursor: `nextCursor` of the previous page, None for the first page
+        video_status: Only return parsed videos with this status
+        fields: Comma-separated fields to return, all of them when None; `_id` and `createdAt` are always returned
+    Returns:
+        - JSON Data with the parsed videos and the cursor of the next page, None on the last page
     """
-    documents = await parsed_video_collection.find({}).sort('createdAt', -1).to_list(length=None)
-    for doc in documents:
-        doc['_id'] = str(doc['_id'])
-    return documents
+    query = get_keyset_query(cursor) if cursor else {}
+    if video_status:
+        query['status'] = video_status
+
+    # _id is converted to a string by the database rather than in a loop over the documents
+    if fields:
+        requested_fields = {field.strip() for field in fields.split(',') if field.strip()} - CURSOR_FIELDS
+        unknown_fields = requested_fields - set(ParsedVideo.model_fields)
+        if unknown_fields:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f'Unknown fields: {", ".join(sorted(unknown_fields))}')
+        projection = {'$project': {'_id': {'$toString': '$_id'}, 'createdAt': 1, **{field: 1 for field in requested_fields}}}
+    else:
+        projection = {'$addFields': {'_id': {'$toString': '$_id'}}}
+
+    # one extra document tells whether there is a next page
+    pipeline = [{'$match': query}, {'$sort': {'createdAt': -1, '_id': -1}}, {'$limit': limit + 1}, projection]
+    documents = await parsed_video_collection.aggregate(pipeline).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1]['createdAt'], ObjectId(documents[-1]['_id']))
+    return {'items': documents, 'nextCursor': next_cursor}
 
 
 # async def update_target_info(entry_id: str, data: UpdateParsedResumeActualInfo, request: Request):
@@ -5,3 +5,42 @@ LOGGER_SERVICE_NAME = 'capae-backend-service'  # This name identifies the logs f
 MEDIA_PATH = 'media/'
 INPUT_FILE_PATH = 'input_video.mp4'
 OUTPUT_FILE_PATH = 'output_video.mp4'
+SEGMENTS_FOLDER_PATH = 'segments'
+PREVIEW_FOLDER_PATH = 'preview'
+PREVIEW_PLAYLIST_PATH = 'index.m3u8'
+DETECTIONS_FOLDER_PATH = 'detections'
+MAX_DETECTION_QUERY_FRAMES = 10000  # frames a single detections query can span
+
+# Listing
+PARSED_VIDEOS_PAGE_SIZE = 20
+MAX_PARSED_VIDEOS_PAGE_SIZE = 100
+
+# Compression
+DECOMPRESSED_CHUNK_SIZE = 64 * 1024  # bytes a gzip/deflate request chunk inflates to at a time
+COMPRESSED_SLICE_SIZE = 4 * 1024  # bytes of a brotli/zstd request chunk decompressed at a time, bounding how much one step can inflate to
+# Responses of these media types are sent as they are, they're already compressed or must reach the client unbuffered
+UNCOMPRESSIBLE_MEDIA_TYPES = (
+    'video/',
+    'audio/',
+    'image/png',
+    'image/jpeg',
+    'image/gif',
+    'image/webp',
+    'application/zip',
+    'application/gzip',
+    'application/zstd',
+    'application/octet-stream',
+    'text/event-stream',
+)
+
+# Model, detecto normalizes frames with the ImageNet statistics before the forward pass
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+ONNX_OPSET_VERSION = 11  # the lowest opset torchvision's detection models export to
+
+# Remote inference, extension and media type of the frames sent to the model server, by INFERENCE_FRAME_FORMAT
+INFERENCE_FRAME_ENCODINGS = {'jpeg': ('.jpg', 'image/jpeg'), 'png': ('.png', 'image/png')}
+
+# Uploads, written outside the public media folder until they're moved into a parsed-video's folder
+UPLOADS_PATH = 'uploads/'
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes
@@ -5,3 +5,42 @@ class Status(str, Enum):
     IN_PROCESS = 'in-process'
     DONE = 'done'
     ERROR = 'error'
+
+
+class DetectionMode(str, Enum):
+    DETECTOR = 'detector'  # run the detector on every frame
+    TRACKER = 'tracker'  # detect until objects are counted, then track them until a tracker fails
+    STRIDED = 'strided'  # detect every few frames and on scene changes, track in between
+
+
+class AppRole(str, Enum):
+    ALL = 'all'
+    API = 'api'
+    WORKER = 'worker'
+
+
+class EncoderBackend(str, Enum):
+    OPENCV = 'opencv'
+    FFMPEG = 'ffmpeg'
+
+
+class InferenceBackend(str, Enum):
+    LOCAL = 'local'
+    REMOTE = 'remote'
+
+
+class ModelEngine(str, Enum):
+    EAGER = 'eager'
+    TORCHSCRIPT = 'torchscript'
+    ONNX = 'onnx'
+
+
+class DetectionSource(str, Enum):
+    DETECTOR = 'detector'
+    TRACKER = 'tracker'
+    REUSED = 'reused'  # boxes of the last detected frame, kept because the frame barely changed
+
+
+class LogFormat(str, Enum):
+    TEXT = 'text'
+    JSON = 'json'
@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from app.server.config.config import MODEL_CLASSES
+from app.server.logger.custom_logger import logger
+from app.server.static.enums import DetectionSource
+
+# One raw binary file per column, rows of all frames back to back
+COLUMNS = {
+    'label': np.uint8,  # index into the labels saved in the meta file
+    'source': np.uint8,  # index into SOURCES
+    'score': np.float32,
+    'xmin': np.int32,
+    'ymin': np.int32,
+    'xmax': np.int32,
+    'ymax': np.int32,
+}
+SOURCES = [DetectionSource.DETECTOR, DetectionSource.TRACKER, DetectionSource.REUSED]
+# offsets[i] is the first row of the i-th frame of the store, offsets[-1] the number of rows
+OFFSETS_FILE_PATH = 'offsets.bin'
+META_FILE_PATH = 'meta.json'
+# Rows buffered in memory before they're appended to the column files
+FLUSH_ROWS = 4096
+
+
+class DetectionWriter:
+    """
+    Appends the boxes of every frame of a job to a compact columnar store.
+
+    Each column is a raw little-endian array on disk, so readers can memory-map them and slice out
+    the rows of any frame range through the offsets file without loading the rest.
+    """
+
+    def __init__(self, folder: str, start_frame: int = 0, fps: float = 30, labels: list[str] = MODEL_CLASSES) -> None:
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.start_frame = start_frame
+        self.fps = fps
+        self.labels = list(labels)
+        self.label_indices = {label: index for index, label in enumerate(self.labels)}
+        self.files = {name: open(os.path.join(folder, f'{name}.bin'), 'wb') for name in COLUMNS}  # pylint: disable=consider-using-with
+        self.buffers = {name: [] for name in COLUMNS}
+        self.frame_counts = []
+
+    def add(self, annotations, source: DetectionSource) -> None:
+        """Adds the next frame's (label, score, xmin, ymin, xmax, ymax) annotations"""
+        self.frame_counts.append(len(annotations))
+        source_index = SOURCES.index(source)
+        for label, score, xmin, ymin, xmax, ymax in annotations:
+            for name, value in zip(COLUMNS, (self.get_label_index(label), source_index, score, xmin, ymin, xmax, ymax)):
+                self.buffers[name].append(value)
+        if len(self.buffers['label']) >= FLUSH_ROWS:
+            self.flush()
+
+    def get_label_index(self, label: str) -> int:
+        """Index of a label in the meta file, labels the store wasn't created with (e.g. of a model server running
+        another model) are added to it"""
+        index = self.label_indices.get(label)
+        if index is None:
+            logger.warning(f'Detection label {label!r} is not one of the model classes, adding it to the labels of {self.folder}')
+            index = self.label_indices[label] = len(self.labels)
+            self.labels.append(label)
+        return index
+
+    def flush(self) -> None:
+        for name, dtype in COLUMNS.items():
+            np.asarray(self.buffers[name], dtype=dtype).tofile(self.files[name])
+            self.buffers[name] = []
+
+    def close(self) -> None:
+        """Writes the remaining rows, the frame offsets and the meta file"""
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        offsets = np.concatenate([[0], np.cumsum(self.frame_counts, dtype=np.int64)]).astype(np.int64)
+        offsets.tofile(os.path.join(self.folder, OFFSETS_FILE_PATH))
+        meta = {'startFrame': self.start_frame, 'frameCount': len(self.frame_counts), 'fps': self.fps, 'labels': self.labels, 'sources': [source.value for source in SOURCES]}
+        with open(os.path.join(self.folder, META_FILE_PATH), 'w', encoding='utf-8') as file:
+            json.dump(meta, file)
+
+
+class DetectionReader:
+    """
+    Reads frame ranges from a store written by `DetectionWriter`, through memory maps
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE_PATH), encoding='utf-8') as file:
+            self.meta = json.load(file)
+        self.offsets = self._map(OFFSETS_FILE_PATH, np.int64)
+        self.columns = {name: self._map(f'{name}.bin', dtype) for name, dtype in COLUMNS.items()}
+
+    @property
+    def fps(self) -> float:
+        return self.meta['fps']
+
+    @property
+    def frame_count(self) -> int:
+        return self.meta['startFrame'] + self.meta['frameCount']
+
+    def query(self, start_frame: int, end_frame: int) -> list[dict]:
+        """
+        Returns the detections of frames `start_frame` (inclusive) to `end_frame` (exclusive)
+
+        Only the rows of those frames are read from disk.
+        """
+        first = min(max(0, start_frame - self.meta['startFrame']), self.meta['frameCount'])
+        last = min(max(first, end_frame - self.meta['startFrame']), self.meta['frameCount'])
+        start_row, end_row = int(self.offsets[first]), int(self.offsets[last])
+        if start_row == end_row:
+            return []
+
+        rows = {name: np.asarray(column[start_row:end_row]) for name, column in self.columns.items()}
+        # Frame of every row, from how many rows each frame in the range has
+        frames = np.repeat(np.arange(first, last) + self.meta['startFrame'], np.diff(self.offsets[first : last + 1]))
+        labels, sources, fps = self.meta['labels'], self.meta['sources'], self.fps
+        return [
+            {'frame': int(frame), 'time': int(frame) / fps, 'label': labels[int(label)], 'score': float(score), 'box': [int(xmin), int(ymin), int(xmax), int(ymax)], 'source': sources[int(source)]}
+            for frame, label, source, score, xmin, ymin, xmax, ymax in zip(frames, *(rows[name] for name in COLUMNS))
+        ]
+
+    def _map(self, file_name, dtype):
+        path = os.path.join(self.folder, file_name)
+        # np.memmap can't map empty files
+        if os.path.getsize(path) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+
+def merge_detection_stores(folders: list[str], out_folder: str) -> None:
+    """Joins the stores of consecutive segments of a video into one store"""
+    os.makedirs(out_folder, exist_ok=True)
+    metas = []
+    for folder in folders:
+        with open(os.path.join(folder, META_FILE_PATH), encoding='utf-8') as file:
+            metas.append(json.load(file))
+
+    # Segments that came across labels outside the model classes each added them in their own order
+    labels = []
+    for meta in metas:
+        labels.extend(label for label in meta['labels'] if label not in labels)
+    label_maps = [np.array([labels.index(label) for label in meta['labels']], dtype=COLUMNS['label']) for meta in metas]
+
+    for name in COLUMNS:
+        with open(os.path.join(out_folder, f'{name}.bin'), 'wb') as out_file:
+            for folder, meta, label_map in zip(folders, metas, label_maps):
+                if name == 'label' and meta['labels'] != labels[: len(meta['labels'])]:
+                    label_map[np.fromfile(os.path.join(folder, f'{name}.bin'), dtype=COLUMNS['label'])].tofile(out_file)
+                    continue
+                with open(os.path.join(folder, f'{name}.bin'), 'rb') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+
+    frame_counts = [np.diff(np.fromfile(os.path.join(folder, OFFSETS_FILE_PATH), dtype=np.int64)) for folder in folders]
+    np.concatenate([[0], np.cumsum(np.concatenate(frame_counts), dtype=np.int64)]).astype(np.int64).tofile(os.path.join(out_folder, OFFSETS_FILE_PATH))
+
+    meta = dict(metas[0], frameCount=sum(meta['frameCount'] for meta in metas), labels=labels)
+    with open(os.path.join(out_folder, META_FILE_PATH), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
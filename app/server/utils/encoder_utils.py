@@ -0,0 +1,111 @@
+import os
+import subprocess
+
+import cv2
+import numpy as np
+
+from app.server.config.config import ENCODER_BACKEND, ENCODER_CRF, ENCODER_FRAGMENTED, ENCODER_PRESET, HLS_SEGMENT_SECONDS
+from app.server.logger.custom_logger import logger
+from app.server.static.constants import PREVIEW_PLAYLIST_PATH
+from app.server.static.enums import EncoderBackend
+
+# Lets browsers start playing an MP4 before it's fully downloaded
+FAST_START_MOVFLAGS = '+faststart'
+# Writes the MP4 as self-contained fragments, so it can be played while it's still being written
+FRAGMENTED_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+
+class OpenCVEncoder:
+    """
+    Writes frames through cv2.VideoWriter with the DIVX codec
+    """
+
+    def __init__(self, output_file: str, fps: float, frame_size: tuple[int, int]) -> None:
+        # Parameters: filename, fourcc, fps, frame_size
+        self.writer = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'DIVX'), fps, frame_size)
+
+    def write(self, frame) -> None:
+        self.writer.write(frame)
+
+    def release(self) -> None:
+        self.writer.release()
+
+
+class FFmpegEncoder:
+    """
+    Pipes raw BGR frames into an ffmpeg process that encodes them to H.264 MP4 in a single pass.
+
+    The MP4 is either fast-start (index at the front, written once encoding ends) or fragmented
+    (playable while it's still being written), so browsers can play it progressively.
+
+    With a `preview_folder`, the same encoded stream is also written as a rolling HLS playlist there,
+    through ffmpeg's tee muxer, so the video can be watched while the job is still running.
+    """
+
+    def __init__(
+        self,
+        output_file: str,
+        fps: float,
+        frame_size: tuple[int, int],
+        preset: str = ENCODER_PRESET,
+        crf: int = ENCODER_CRF,
+        fragmented: bool = ENCODER_FRAGMENTED,
+        preview_folder: str = None,
+        segment_seconds: int = HLS_SEGMENT_SECONDS,
+    ) -> None:
+        width, height = frame_size
+        movflags = FRAGMENTED_MOVFLAGS if fragmented else FAST_START_MOVFLAGS
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+        command += ['-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p']
+        if preview_folder:
+            os.makedirs(preview_folder, exist_ok=True)
+            # HLS segments can only start on keyframes, so force one at every segment boundary
+            command += ['-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})']
+            hls_options = f'f=hls:hls_time={segment_seconds}:hls_list_size=0:hls_playlist_type=event:hls_segment_filename={os.path.join(preview_folder, "segment_%05d.ts")}'
+            command += ['-map', '0:v', '-f', 'tee', f'[f=mp4:movflags={movflags}]{output_file}|[{hls_options}]{os.path.join(preview_folder, PREVIEW_PLAYLIST_PATH)}']
+        else:
+            command += ['-movflags', movflags, output_file]
+        self.output_file = output_file
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame) -> None:
+        try:
+            # Contiguous frames are handed to the pipe without copying
+            self.process.stdin.write(np.ascontiguousarray(frame))
+        except BrokenPipeError as error:
+            raise RuntimeError(f'ffmpeg stopped encoding {self.output_file}: {self._read_error()}') from error
+
+    def release(self) -> None:
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed to encode {self.output_file}: {self._read_error()}')
+
+    def _read_error(self) -> str:
+        self.process.kill()
+        self.process.wait()
+        return self.process.stderr.read().decode(errors='replace').strip()
+
+
+def create_encoder(output_file: str, fps: float, frame_size: tuple[int, int], preview_folder: str = None, backend: str = ENCODER_BACKEND):
+    """Creates the encoder that writes the annotated video
+
+    Args:
+        output_file (str): Path of the output video
+        fps (float): Frames per second of the output video
+        frame_size (tuple): (width, height) of the frames
+        preview_folder (str): Folder a live HLS preview is written to, None for no preview
+        backend (str): One of `EncoderBackend`
+
+    Returns:
+        An object with `write(frame)` and `release()`, like cv2.VideoWriter
+    """
+    if EncoderBackend(backend) == EncoderBackend.FFMPEG:
+        return FFmpegEncoder(output_file, fps, frame_size, preview_folder=preview_folder)
+    if preview_folder:
+        logger.warning('Live HLS preview needs the ffmpeg encoder backend, no preview is written')
+    return OpenCVEncoder(output_file, fps, frame_size)
@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+
+from app.server.config.config import INFERENCE_SIZE
+from app.server.logger.custom_logger import logger
+from app.server.static.constants import IMAGENET_MEAN, IMAGENET_STD, ONNX_OPSET_VERSION
+from app.server.static.enums import ModelEngine
+
+# Shapes the normalization broadcasts over, images are HWC
+MEAN = np.array(IMAGENET_MEAN, dtype=np.float32).reshape(1, 1, 3)
+STD = np.array(IMAGENET_STD, dtype=np.float32).reshape(1, 1, 3)
+# Longest side the model's own resize allows, as a multiple of the shorter one, wide enough for any video
+MAX_ASPECT_RATIO = 4
+
+
+def get_engine_path(model_path: str, engine: str, quantize: bool = False) -> str:
+    """Path of the artifact `export_model` writes for an engine, next to the weights, e.g. app/data/Train.int8.onnx"""
+    extension = '.onnx' if ModelEngine(engine) == ModelEngine.ONNX else '.torchscript.pt'
+    return os.path.splitext(model_path)[0] + ('.int8' if quantize else '') + extension
+
+
+def set_input_size(model, inference_size: int = INFERENCE_SIZE) -> None:
+    """Makes the resize built into a torchvision detection model keep frames at the size `predict_frames` scaled them to
+
+    The model resizes every image to a shorter side of 800 pixels (and a longer side of at most 1333) before the
+    backbone runs, which would scale frames downscaled to `inference_size` back up. With `inference_size` 0 the
+    model's own sizes are kept.
+    """
+    if inference_size > 0:
+        model.transform.min_size = (inference_size,)
+        model.transform.max_size = inference_size * MAX_ASPECT_RATIO
+
+
+def normalize_image(image) -> np.ndarray:
+    """Converts an HWC uint8 frame to the CHW float input of the model, as detecto's default transforms do"""
+    return np.ascontiguousarray(((image.astype(np.float32) / 255 - MEAN) / STD).transpose(2, 0, 1))
+
+
+def to_prediction(classes, labels, boxes, scores):
+    """Converts raw model output to detecto's (labels, boxes, scores), with numpy boxes and scores"""
+    return [classes[label] for label in labels.tolist()], boxes.astype(np.float32).reshape(-1, 4), scores.astype(np.float32).reshape(-1)
+
+
+class TorchScriptModel:
+    """Runs a model exported with TorchScript, `predict` behaves like detecto's"""
+
+    def __init__(self, path: str, classes: list[str]) -> None:
+        import torch  # pylint: disable=import-outside-toplevel
+
+        self.torch = torch
+        self.module = torch.jit.load(path, map_location='cpu').eval()
+        # Index 0 is the background class, as in detecto
+        self.classes = ['__background__'] + list(classes)
+
+    def predict(self, images):
+        if not isinstance(images, list):
+            return self.predict([images])[0]
+        with self.torch.inference_mode():
+            # Scripted detection models return (losses, detections) in every mode
+            _, detections = self.module([self.torch.from_numpy(normalize_image(image)) for image in images])
+        return [to_prediction(self.classes, detection['labels'].numpy(), detection['boxes'].numpy(), detection['scores'].numpy()) for detection in detections]
+
+
+class OnnxModel:
+    """Runs a model exported to ONNX with ONNX Runtime, `predict` behaves like detecto's"""
+
+    def __init__(self, path: str, classes: list[str]) -> None:
+        import onnxruntime  # pylint: disable=import-outside-toplevel
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.classes = ['__background__'] + list(classes)
+
+    def predict(self, images):
+        if not isinstance(images, list):
+            return self.predict([images])[0]
+        predictions = []
+        # The exported graph takes a single image, batches are run an image at a time
+        for image in images:
+            boxes, labels, scores = self.session.run(['boxes', 'labels', 'scores'], {self.input_name: normalize_image(image)})
+            predictions.append(to_prediction(self.classes, labels, boxes, scores))
+        return predictions
+
+
+def quantize_linear_layers(module):
+    """Dynamically quantizes the fully connected layers (the box head) to int8, convolutions stay in float"""
+    import torch  # pylint: disable=import-outside-toplevel
+
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_engine(model_path: str, classes: list[str], engine: str, quantize: bool = False):
+    """Loads the exported artifact of an engine
+
+    Returns:
+        An object with detecto's `predict`
+    """
+    path = get_engine_path(model_path, engine, quantize)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{path} not found, create it with `python -m app.export_model --engine {ModelEngine(engine).value}{" --quantize" if quantize else ""}`')
+    if ModelEngine(engine) == ModelEngine.ONNX:
+        return OnnxModel(path, classes)
+    return TorchScriptModel(path, classes)
+
+
+def export_model(model_path: str, classes: list[str], engine: str, quantize: bool = False, sample_size: int = INFERENCE_SIZE or 800) -> str:
+    """Exports the detecto model at `model_path` for an engine
+
+    Args:
+        model_path (str): Weights of the detecto model
+        classes (list): Classes of the model, in training order
+        engine (str): `ModelEngine.TORCHSCRIPT` or `ModelEngine.ONNX`
+        quantize (bool): Whether to also quantize the fully connected layers to int8
+        sample_size (int): Shorter side of the sample image the ONNX graph is traced with, height and width stay dynamic
+
+    Returns:
+        str: Path of the artifact, see `get_engine_path`
+    """
+    # pylint: disable=import-outside-toplevel
+    import torch
+    from detecto import core
+
+    model = core.Model.load(model_path, classes)._model.eval()  # pylint: disable=protected-access
+    # The resize is part of the exported graph, so the artifacts run at the INFERENCE_SIZE they were exported with
+    set_input_size(model)
+    path = get_engine_path(model_path, engine, quantize)
+
+    if ModelEngine(engine) == ModelEngine.TORCHSCRIPT:
+        if quantize:
+            model = quantize_linear_layers(model)
+        scripted = torch.jit.script(model)
+        try:
+            # Folds the weights into the graph as constants, not every torchvision version's detection models support it
+            scripted = torch.jit.freeze(scripted)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning(f'TorchScript model could not be frozen, saving it unfrozen: {error}')
+        torch.jit.save(scripted, path)
+        return path
+
+    # ONNX Runtime quantizes the float graph itself, so the float one is exported first in either case
+    float_path = get_engine_path(model_path, engine)
+    sample = torch.rand(3, sample_size, sample_size * 16 // 9)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            ([sample],),
+            float_path,
+            opset_version=ONNX_OPSET_VERSION,
+            input_names=['image'],
+            output_names=['boxes', 'labels', 'scores'],
+            dynamic_axes={'image': {1: 'height', 2: 'width'}, 'boxes': {0: 'detections'}, 'labels': {0: 'detections'}, 'scores': {0: 'detections'}},
+        )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # Like the TorchScript engine, only the fully connected layers are quantized, int8 convolutions cost accuracy for little speed on CPU
+        quantize_dynamic(float_path, path, op_types_to_quantize=['MatMul', 'Gemm'], weight_type=QuantType.QInt8)
+    return path
@@ -1,11 +1,15 @@
+import hashlib
 import io
 import os
 from uuid import uuid4
 
 import aiofiles
 from fastapi import HTTPException, UploadFile, status
+from starlette.concurrency import run_in_threadpool
 
+from app.server.config.config import MAX_UPLOAD_SIZE
 from app.server.logger.custom_logger import logger
+from app.server.static.constants import UPLOAD_CHUNK_SIZE
 
 current_path = os.path.dirname(__file__)
 
@@ -84,6 +88,66 @@ async def save_file(out_file_path: str, file_bytes: bytes) -> None:
         await out_file.write(file_bytes)
 
 
+def is_video_container(header: bytes) -> bool:
+    """Checks the first bytes of a file against the signatures of the video containers OpenCV can read
+
+    Args:
+        header (bytes): The first bytes of the file, MPEG-TS is only recognized with at least two packets (189 bytes)
+
+    Returns:
+        bool: True for MP4/MOV/3GP, AVI, Matroska/WebM and MPEG-TS files
+    """
+    if header[4:8] == b'ftyp':  # ISO base media: mp4, mov, 3gp
+        return True
+    if header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+        return True
+    if header[:4] == b'\x1a\x45\xdf\xa3':  # EBML: mkv, webm
+        return True
+    # MPEG-TS: 188-byte packets, each starting with the 0x47 sync byte
+    return header[:1] == b'\x47' and header[188:189] == b'\x47'
+
+
+def _write_chunk(out_file, content_hash, chunk: bytes) -> None:
+    content_hash.update(chunk)
+    out_file.write(chunk)
+
+
+async def save_upload_file(upload_file: UploadFile, out_file_path: str, max_size: int = MAX_UPLOAD_SIZE, chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    """Streams an uploaded video to disk in fixed-size chunks without blocking the event loop.
+
+    In the same pass the container header is validated, the size is capped and the content is hashed.
+    The partially written file is removed when the upload is rejected.
+
+    Args:
+        upload_file (UploadFile): The uploaded file
+        out_file_path (str): Path the file is written to
+        max_size (int): Maximum allowed size of the file in bytes
+        chunk_size (int): Bytes read and written at a time
+
+    Returns:
+        str: SHA-256 hex digest of the file content
+    """
+    content_hash = hashlib.sha256()
+    size = 0
+    try:
+        with open(out_file_path, 'wb') as out_file:
+            while chunk := await upload_file.read(chunk_size):
+                if size == 0 and not is_video_container(chunk):
+                    raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=f'File: {upload_file.filename} is not a supported video container')
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f'File: {upload_file.filename} size exceeds the allowed size of {max_size} bytes')
+                # hashing and writing both release the GIL, so they run together off the event loop
+                await run_in_threadpool(_write_chunk, out_file, content_hash, chunk)
+        if size == 0:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f'File: {upload_file.filename} is empty')
+    except BaseException:
+        if os.path.exists(out_file_path):
+            os.remove(out_file_path)
+        raise
+    return content_hash.hexdigest()
+
+
 def bytes_to_buffer(file_bytes: bytes) -> io.BytesIO:
     """Converts bytes to buffer type object
 
@@ -151,7 +215,10 @@ def check_allowed_size(file: UploadFile, allowed_size: int) -> bool:
     Returns:
       A boolean value.
     """
-    if len(file.file.read()) > (allowed_size * 1000):
-        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f'File: {file.filename} size exceeds the allowed size of {allowed_size} KB')
+    # Measure the spooled file by seeking to its end instead of reading it into memory
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
     file.file.seek(0)
+    if size > (allowed_size * 1000):
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f'File: {file.filename} size exceeds the allowed size of {allowed_size} KB')
     return True
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from app.server.config.config import INFERENCE_BACKEND, INFERENCE_FRAME_FORMAT, INFERENCE_JPEG_QUALITY, INFERENCE_SERVER_URL, INFERENCE_SIZE
+from app.server.http_client.http_client import HttpClientPool, RestClient, http_client_pool
+from app.server.logger.custom_logger import logger
+from app.server.static.constants import INFERENCE_FRAME_ENCODINGS
+from app.server.static.enums import InferenceBackend
+from app.server.utils.model_utils import ModelLoader, model_loader
+
+
+def to_numpy_prediction(prediction):
+    """Converts a prediction of the model, detecto's CPU tensors or an exported engine's arrays, to (labels, boxes, scores)
+    with numpy boxes of shape (N, 4) and scores of shape (N,)"""
+    labels, boxes, scores = prediction
+    return list(labels), np.asarray(boxes, dtype=np.float32).reshape(-1, 4), np.asarray(scores, dtype=np.float32).reshape(-1)
+
+
+def from_json_prediction(prediction):
+    """Converts a prediction of the model server's JSON response to (labels, boxes, scores) numpy arrays"""
+    return list(prediction['labels']), np.asarray(prediction['boxes'], dtype=np.float32).reshape(-1, 4), np.asarray(prediction['scores'], dtype=np.float32).reshape(-1)
+
+
+def to_json_prediction(prediction):
+    labels, boxes, scores = prediction
+    return {'labels': list(labels), 'boxes': np.asarray(boxes).tolist(), 'scores': np.asarray(scores).tolist()}
+
+
+class LocalInferenceBackend:
+    """Runs the detection model in this process, loaded on first use by `loader`"""
+
+    def __init__(self, loader: ModelLoader) -> None:
+        self.loader = loader
+
+    def predict(self, images):
+        # Like detecto, a list is a batch and gets a list of predictions back
+        if not isinstance(images, list):
+            return self.predict([images])[0]
+        return [to_numpy_prediction(prediction) for prediction in self.loader.get().predict(images)]
+
+    def warm_up(self) -> None:
+        self.loader.warm_up()
+
+    def is_ready(self) -> bool:
+        return self.loader.is_ready()
+
+
+class RemoteInferenceBackend:
+    """
+    Sends frames to a model server (`app.inference_server`) and reads the predictions back.
+
+    A batch goes out as a single multipart request of JPEG or PNG encoded frames. Detection runs in worker
+    threads and segment processes, so requests are sent from an event loop this backend runs in its own thread,
+    through its own connection pool, which works the same whether or not the caller's process has an app loop.
+    """
+
+    def __init__(self, base_url: str, frame_format: str = INFERENCE_FRAME_FORMAT, jpeg_quality: int = INFERENCE_JPEG_QUALITY) -> None:
+        self.extension, self.media_type = INFERENCE_FRAME_ENCODINGS[frame_format]
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if frame_format == 'jpeg' else []
+        self.client = RestClient(base_url, pool=HttpClientPool(http_client_pool.limits, http_client_pool.timeout))
+        self.loop = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def predict(self, images):
+        if not isinstance(images, list):
+            return self.predict([images])[0]
+        if not images:
+            return []
+        files = [('frames', (f'{index}{self.extension}', self._encode(image), self.media_type)) for index, image in enumerate(images)]
+        response = asyncio.run_coroutine_threadsafe(self.client.post_file('/predict', files=files), self._get_loop()).result()
+        predictions = response.get('predictions') if isinstance(response, dict) else None
+        if predictions is None or len(predictions) != len(images):
+            raise RuntimeError(f'Inference server returned no predictions for {len(images)} frames: {response}')
+        return [from_json_prediction(prediction) for prediction in predictions]
+
+    def warm_up(self) -> None:
+        """Sends a blank frame, so the server is known to be reachable and its model loaded before the first job"""
+        start_time = time.time()
+        size = INFERENCE_SIZE or 800
+        self.predict(np.zeros((size, size, 3), dtype=np.uint8))
+        self.ready.set()
+        logger.debug(f'Inference server {self.client.base_url} answered in {time.time() - start_time:.2f}s')
+
+    def is_ready(self) -> bool:
+        return self.ready.is_set()
+
+    def _encode(self, image) -> bytes:
+        encoded, buffer = cv2.imencode(self.extension, image, self.encode_params)
+        if not encoded:
+            raise ValueError(f'Frame could not be encoded as {self.extension}')
+        return buffer.tobytes()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        if self.loop is None:
+            with self.lock:
+                if self.loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='inference-client', daemon=True).start()
+                    self.loop = loop
+        return self.loop
+
+
+def create_inference_backend(backend: str = INFERENCE_BACKEND):
+    """Creates the backend the detection loops run the model through
+
+    Args:
+        backend (str): One of `InferenceBackend`
+
+    Returns:
+        An object with `predict(images)`, `warm_up()` and `is_ready()`. Like detecto, `predict` takes a frame
+        or a list of frames and returns (labels, boxes, scores) for each, with boxes as an (N, 4) numpy array
+        of xmin, ymin, xmax, ymax
+    """
+    if InferenceBackend(backend) == InferenceBackend.REMOTE:
+        return RemoteInferenceBackend(INFERENCE_SERVER_URL)
+    return LocalInferenceBackend(model_loader)
+
+
+inference_backend = create_inference_backend()
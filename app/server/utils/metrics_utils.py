@@ -0,0 +1,148 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Seconds, from sub-millisecond codec work up to a model forward pass on a slow CPU
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+
+# Every metric created in this process, in creation order
+registry = []
+
+
+class Metric:
+    """
+    Base of the metrics below: a name, help text, label names and one value per combination of label values
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.extend(self._render_sample(label_values, value))
+        return lines
+
+    def _render_sample(self, label_values, value) -> list[str]:
+        return [f'{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}']
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down; with a `function`, the value is read from it whenever metrics are rendered
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (), function: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values: str) -> None:
+        with self.lock:
+            self.values[label_values] = value
+
+    def render(self) -> list[str]:
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets, plus their sum and count
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = STAGE_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values: str, count: int = 1) -> None:
+        """Records `count` observations of `value`, e.g. the per-frame share of a batch"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(label_values, (None, 0.0))
+            if counts is None:
+                # One slot per bucket plus +Inf, made cumulative when rendered
+                counts = [0] * (len(self.buckets) + 1)
+            counts[index] += count
+            self.values[label_values] = (counts, total + value * count)
+
+    @contextmanager
+    def time(self, *label_values: str):
+        """Observes how long the block took"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *label_values)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted((label_values, (list(counts), total)) for label_values, (counts, total) in self.values.items())
+        for label_values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = format_labels(self.label_names + ('le',), label_values + (format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def format_labels(label_names, label_values) -> str:
+    if not label_names:
+        return ''
+    pairs = (f'{name}="{escape_label_value(str(value))}"' for name, value in zip(label_names, label_values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics() -> str:
+    """Renders every metric of this process in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process; segment worker processes keep their own, which aren't exported
+stage_seconds = Histogram('capae_pipeline_stage_seconds', 'Time spent per frame in each stage of the video pipeline', ('stage',))
+queue_depth = Gauge('capae_pipeline_queue_depth', 'Frames waiting in the queues between pipeline stages, across jobs', ('queue',))
+job_seconds = Histogram('capae_job_duration_seconds', 'Duration of detection jobs', ('mode', 'status'), buckets=JOB_BUCKETS)
+http_request_seconds = Histogram('capae_http_request_duration_seconds', 'Time until the response starts, per route', ('method', 'route', 'status'), buckets=HTTP_BUCKETS)
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import numpy as np
+
+from app.server.config.config import INFERENCE_SIZE, MODEL_CLASSES, MODEL_ENGINE, MODEL_PATH, MODEL_QUANTIZE
+from app.server.logger.custom_logger import logger
+from app.server.static.enums import ModelEngine
+from app.server.utils.engine_utils import load_engine, quantize_linear_layers, set_input_size
+
+
+class ModelLoader:
+    """
+    Loads the detection model on first use instead of at import time.
+
+    torch, torchvision and detecto are only imported when the model is needed, so processes that
+    never run detection (the API role) start without paying for them. `engine` picks between the detecto
+    model and the artifacts of `app.export_model`, which all predict in detecto's format.
+    """
+
+    def __init__(self, model_path: str, classes: list[str], engine: str = MODEL_ENGINE, quantize: bool = MODEL_QUANTIZE) -> None:
+        self.model_path = model_path
+        self.classes = classes
+        self.engine = ModelEngine(engine)
+        self.quantize = quantize
+        self.model = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def get(self):
+        """Returns the model, loading it on the first call"""
+        if self.model is None:
+            with self.lock:
+                if self.model is None:
+                    start_time = time.time()
+                    self.model = self._load()
+                    logger.debug(f'Loaded model {self.model_path} ({self.engine.value}{", int8" if self.quantize else ""}) in {time.time() - start_time:.2f}s')
+        return self.model
+
+    def _load(self):
+        if self.engine != ModelEngine.EAGER:
+            return load_engine(self.model_path, self.classes, self.engine, self.quantize)
+
+        from detecto import core  # pylint: disable=import-outside-toplevel
+
+        model = core.Model.load(self.model_path, self.classes)
+        set_input_size(model._model)  # pylint: disable=protected-access
+        if self.quantize:
+            model._model = quantize_linear_layers(model._model)  # pylint: disable=protected-access
+        return model
+
+    def warm_up(self) -> None:
+        """Loads the model and runs one prediction on a blank frame, so the first job doesn't pay for lazy initialisation"""
+        start_time = time.time()
+        size = INFERENCE_SIZE or 800
+        self.get().predict(np.zeros((size, size, 3), dtype=np.uint8))
+        self.ready.set()
+        logger.debug(f'Model warmed up in {time.time() - start_time:.2f}s')
+
+    def is_ready(self) -> bool:
+        return self.ready.is_set()
+
+
+model_loader = ModelLoader(MODEL_PATH, MODEL_CLASSES)
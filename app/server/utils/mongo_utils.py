@@ -0,0 +1,68 @@
+import base64
+import datetime
+from datetime import timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException, status
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from app.server.config.databases import db
+from app.server.logger.custom_logger import logger
+
+# Indexes of every collection, created at startup
+INDEXES = {
+    'parsed_videos': [
+        # Listing, newest first, with _id breaking ties between entries created in the same millisecond
+        IndexModel([('createdAt', DESCENDING), ('_id', DESCENDING)], name='createdAt_id'),
+        # Listing filtered by status
+        IndexModel([('status', ASCENDING), ('createdAt', DESCENDING), ('_id', DESCENDING)], name='status_createdAt_id'),
+        # Reusing finished results of re-uploaded videos
+        IndexModel([('contentHash', ASCENDING), ('status', ASCENDING)], name='contentHash_status'),
+        # Workers claiming the oldest unclaimed video
+        IndexModel([('status', ASCENDING), ('claimed', ASCENDING), ('createdAt', ASCENDING)], name='status_claimed_createdAt'),
+        # Workers taking over claims whose heartbeat stopped
+        IndexModel([('status', ASCENDING), ('claimedAt', ASCENDING)], name='status_claimedAt'),
+    ]
+}
+
+
+async def create_indexes():
+    """Creates the indexes of every collection, existing indexes are left as they are"""
+    for collection_name, indexes in INDEXES.items():
+        names = await db.get_collection(collection_name).create_indexes(indexes)
+        logger.debug(f'Indexes of {collection_name}: {", ".join(names)}')
+
+
+def encode_cursor(created_at: datetime.datetime, entry_id: ObjectId) -> str:
+    """
+    Encodes the sort key of the last document of a page as an opaque cursor
+
+    Args:
+        created_at: createdAt of the document, Mongo returns it as naive UTC
+        entry_id: _id of the document
+    Returns:
+        - URL-safe cursor string
+    """
+    millis = int(created_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return base64.urlsafe_b64encode(f'{millis}:{entry_id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, ObjectId]:
+    """
+    Decodes a cursor made by `encode_cursor`
+
+    Returns:
+        - (createdAt, _id) of the last document of the previous page
+    """
+    try:
+        millis, entry_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return datetime.datetime.fromtimestamp(int(millis) / 1000, timezone.utc), ObjectId(entry_id)
+    except (ValueError, InvalidId) as error:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Invalid cursor') from error
+
+
+def get_keyset_query(cursor: str) -> dict:
+    """Matches the documents after the cursor in (createdAt, _id) descending order"""
+    created_at, entry_id = decode_cursor(cursor)
+    return {'$or': [{'createdAt': {'$lt': created_at}}, {'createdAt': created_at, '_id': {'$lt': entry_id}}]}
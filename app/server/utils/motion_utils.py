@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+
+# Size frames are shrunk to before comparing them, small enough that a difference costs microseconds
+THUMBNAIL_SIZE = (64, 36)
+
+
+def get_thumbnail(frame, size=THUMBNAIL_SIZE):
+    """Shrinks a frame to a small grayscale image used to compare frames cheaply
+
+    Args:
+        frame (numpy.ndarray): BGR frame
+        size (tuple): (width, height) of the thumbnail
+
+    Returns:
+        numpy.ndarray: Grayscale thumbnail as float32 in the range [0, 1]
+    """
+    gray = cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    return gray.astype(np.float32) / 255.0
+
+
+def get_frame_difference(previous_thumbnail, thumbnail):
+    """Mean absolute difference between two thumbnails, 0 for identical frames and 1 for black against white"""
+    if previous_thumbnail is None:
+        return 1.0
+    return float(np.mean(np.abs(thumbnail - previous_thumbnail)))
+
+
+class MotionGate:
+    """
+    Decides which frames need the detector, letting frames that barely changed reuse the last detections.
+
+    Frames are compared with the last frame the detector ran on rather than with the previous frame, so slow
+    drift adds up until it crosses `threshold`. The detector also runs after `interval` frames in a row were let through.
+    """
+
+    def __init__(self, threshold, interval):
+        """
+        Args:
+            threshold (float): Frame difference (0-1), see `get_frame_difference`, at or above which the detector runs
+            interval (int): Most frames in a row that can reuse detections
+        """
+        self.threshold = threshold
+        self.interval = max(1, interval)
+        self.reference = None
+        self.reused_frames = 0
+
+    def should_detect(self, frame):
+        thumbnail = get_thumbnail(frame)
+        if self.reused_frames >= self.interval or get_frame_difference(self.reference, thumbnail) >= self.threshold:
+            self.reference = thumbnail
+            self.reused_frames = 0
+            return True
+        self.reused_frames += 1
+        return False
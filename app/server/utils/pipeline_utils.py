@@ -0,0 +1,209 @@
+import contextlib
+import contextvars
+import queue
+import threading
+
+import cv2
+
+from app.server.config.config import PIPELINE_ANNOTATE_QUEUE_DEPTH, PIPELINE_DECODE_QUEUE_DEPTH, PIPELINE_ENCODE_QUEUE_DEPTH
+from app.server.jobs.job_cancel import raise_if_cancelled
+from app.server.logger.custom_logger import logger
+from app.server.static.enums import DetectionSource
+from app.server.utils.metrics_utils import queue_depth, stage_seconds
+
+# Marks the end of the stream in every stage queue
+END_OF_STREAM = object()
+
+# How often a blocked stage checks whether the pipeline was stopped, in seconds
+POLL_INTERVAL = 0.1
+
+
+def get_annotations(predictions, score_filter):
+    """Converts detector output to the boxes drawn on a frame
+
+    Args:
+        predictions (tuple): (labels, boxes, scores) as returned by the model, boxes in xmin, ymin, xmax, ymax
+        score_filter (float): Minimum score required to show a prediction
+
+    Returns:
+        list: (label, score, xmin, ymin, xmax, ymax) for every prediction that passes the filter
+    """
+    annotations = []
+    for label, box, score in zip(*predictions):
+        if score < score_filter:
+            continue
+        annotations.append((label, float(score), int(box[0]), int(box[1]), int(box[2]), int(box[3])))
+    return annotations
+
+
+def draw_annotations(frame, annotations):
+    """Draws labelled boxes on a frame in place
+
+    Args:
+        frame (numpy.ndarray): The frame to draw on
+        annotations (list): (label, score, xmin, ymin, xmax, ymax) tuples
+    """
+    for label, score, xmin, ymin, xmax, ymax in annotations:
+        # Parameters: frame, (start_x, start_y), (end_x, end_y), (r, g, b), thickness
+        cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)  # Green rectangle
+        cv2.putText(frame, f'{label}: {round(score, 2)}', (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 3)
+
+
+class VideoPipeline:
+    """
+    Runs decode, annotate and encode on background threads connected by bounded queues.
+
+    The caller's thread only runs inference: it pulls decoded frames with `read_frames` and hands each frame
+    back with its annotations through `write`, in order. OpenCV releases the GIL while decoding, drawing and
+    encoding, so codec time overlaps with model time, and the queue depths cap how many frames are held in memory.
+
+    Use it as a context manager; leaving the block flushes the remaining frames and re-raises any stage error.
+    `read_frames` raises `JobCancelled` once the job is cancelled, which stops the stages without flushing.
+    `start_frame` and `frame_count` restrict decoding to a range of the video. With a `store`
+    (a `detection_utils.DetectionWriter`), the annotations of every frame are also recorded there.
+    """
+
+    def __init__(
+        self, video, out, start_frame=0, frame_count=None, store=None, decode_depth=PIPELINE_DECODE_QUEUE_DEPTH, annotate_depth=PIPELINE_ANNOTATE_QUEUE_DEPTH, encode_depth=PIPELINE_ENCODE_QUEUE_DEPTH
+    ) -> None:
+        self.video = video
+        self.out = out
+        self.start_frame = start_frame
+        self.frame_count = frame_count
+        self.store = store
+        self.decoded = queue.Queue(maxsize=max(1, decode_depth))
+        self.annotating = queue.Queue(maxsize=max(1, annotate_depth))
+        self.encoding = queue.Queue(maxsize=max(1, encode_depth))
+        self.queue_names = {id(stage_queue): name for name, stage_queue in self._queues()}
+        self.stop_event = threading.Event()
+        self.decode_stop_event = threading.Event()
+        self.error = None
+        self.finished = False
+        # Stage threads log with the context fields of the job that created the pipeline
+        self.threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(self._run_stage, name, stage), name=f'pipeline-{name}', daemon=True)
+            for name, stage in (('decode', self._decode), ('annotate', self._annotate), ('encode', self._encode))
+        ]
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The decoder may still be blocked on a full queue if the caller stopped reading early
+        self.decode_stop_event.set()
+        if exc_type is None:
+            # Let the annotate and encode stages drain what was already written
+            self._put(self.annotating, END_OF_STREAM)
+        else:
+            self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        # Frames left behind by an early stop no longer count as waiting
+        for name, stage_queue in self._queues():
+            while not stage_queue.empty():
+                if stage_queue.get_nowait() is not END_OF_STREAM:
+                    queue_depth.dec(name)
+        if exc_type is not None or self.error is not None:
+            # Don't leave an encoder process running after a failed job
+            with contextlib.suppress(Exception):
+                self.out.release()
+        if self.error is not None and exc_type is None:
+            raise self.error
+        if self.store is not None and exc_type is None:
+            self.store.close()
+        return False
+
+    def read_frames(self, count):
+        """Takes up to `count` decoded frames, fewer (or none) once the video ends"""
+        raise_if_cancelled()
+        frames = []
+        while len(frames) < count and not self.finished:
+            item = self._get(self.decoded)
+            if item is END_OF_STREAM:
+                self.finished = True
+                break
+            frames.append(item)
+        return frames
+
+    def write(self, frame, annotations, source=DetectionSource.DETECTOR):
+        """Queues a frame to be annotated and encoded, frames are written in the order they're queued
+
+        `source` tells whether the annotations came from the detector, from trackers or were reused from an earlier frame.
+        """
+        self._put(self.annotating, (frame, annotations, source))
+
+    def _run_stage(self, name, stage):
+        try:
+            with logger.contextualize(stage=name):
+                stage()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.debug(f'Pipeline stage {name} failed: {error}')
+            self.error = error
+            self.stop_event.set()
+            self.decode_stop_event.set()
+
+    def _decode(self):
+        if self.start_frame:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+        decoded_frames = 0
+        while not self.decode_stop_event.is_set():
+            if self.frame_count is not None and decoded_frames >= self.frame_count:
+                break
+            decoded_frames += 1
+            with stage_seconds.time('decode'):
+                ret, frame = self.video.read()
+            if not ret:
+                break
+            if not self._put(self.decoded, frame, self.decode_stop_event):
+                return
+        self._put(self.decoded, END_OF_STREAM, self.decode_stop_event)
+
+    def _annotate(self):
+        while True:
+            item = self._get(self.annotating)
+            if item is END_OF_STREAM:
+                self._put(self.encoding, END_OF_STREAM)
+                return
+            frame, annotations, source = item
+            if self.store is not None:
+                self.store.add(annotations, source)
+            with stage_seconds.time('draw'):
+                draw_annotations(frame, annotations)
+            if not self._put(self.encoding, frame):
+                return
+
+    def _encode(self):
+        while True:
+            frame = self._get(self.encoding)
+            if frame is END_OF_STREAM:
+                return
+            with stage_seconds.time('encode'):
+                self.out.write(frame)
+
+    def _queues(self):
+        return (('decoded', self.decoded), ('annotating', self.annotating), ('encoding', self.encoding))
+
+    def _put(self, stage_queue, item, stop_event=None):
+        stop_event = stop_event or self.stop_event
+        while not stop_event.is_set():
+            try:
+                stage_queue.put(item, timeout=POLL_INTERVAL)
+                if item is not END_OF_STREAM:
+                    queue_depth.inc(self.queue_names[id(stage_queue)])
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, stage_queue):
+        while not self.stop_event.is_set():
+            try:
+                item = stage_queue.get(timeout=POLL_INTERVAL)
+                if item is not END_OF_STREAM:
+                    queue_depth.dec(self.queue_names[id(stage_queue)])
+                return item
+            except queue.Empty:
+                continue
+        return END_OF_STREAM
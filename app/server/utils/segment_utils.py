@@ -0,0 +1,223 @@
+import bisect
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+
+import cv2
+
+from app.server.config.config import SEGMENT_MIN_FRAMES, SEGMENT_WORKERS
+from app.server.jobs.cpu_budget import cpu_budget
+from app.server.jobs.job_cancel import cancel_event, raise_if_cancelled
+from app.server.logger.custom_logger import logger
+from app.server.utils.detection_utils import merge_detection_stores
+from app.server.utils.encoder_utils import FAST_START_MOVFLAGS
+
+# Frames a worker processes before it reports progress back to the job
+PROGRESS_REPORT_FRAMES = 25
+# How often the job checks whether it was cancelled while its segments are processed, in seconds
+CANCEL_POLL_INTERVAL = 0.5
+
+segment_executor = None
+segment_executor_lock = threading.Lock()
+
+
+def get_segment_executor():
+    """Returns the process pool shared by all jobs, started on first use
+
+    Processes are spawned rather than forked so each one sets up its own inference backend, its own copy of the
+    model or its own client of the model server, instead of inheriting the parent's threads and locks.
+    """
+    global segment_executor  # pylint: disable=global-statement
+    with segment_executor_lock:
+        if segment_executor is None:
+            segment_executor = ProcessPoolExecutor(max_workers=max(1, SEGMENT_WORKERS), mp_context=multiprocessing.get_context('spawn'))
+    return segment_executor
+
+
+def get_keyframe_indices(input_file, fps):
+    """Lists the frame indices of the video's keyframes
+
+    Only packet headers are read, nothing is decoded.
+
+    Args:
+        input_file (str): Path of the video
+        fps (float): Frame rate used to convert keyframe timestamps to frame indices
+
+    Returns:
+        list: Sorted keyframe indices, empty when ffprobe isn't available or fails
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', input_file]
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as error:
+        logger.warning(f'Could not read keyframes of {input_file}, splitting at arbitrary frames: {error}')
+        return []
+
+    indices = set()
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if flags.startswith('K') and pts_time not in ('', 'N/A'):
+            indices.add(round(float(pts_time) * fps))
+    return sorted(indices)
+
+
+def get_segments(total_frames, keyframes, workers=SEGMENT_WORKERS, min_frames=SEGMENT_MIN_FRAMES):
+    """Splits a video into up to `workers` segments of similar length, starting each one at a keyframe
+
+    Args:
+        total_frames (int): Number of frames in the video
+        keyframes (list): Sorted keyframe indices, segments start at arbitrary frames when empty
+        workers (int): Maximum number of segments
+        min_frames (int): Minimum length of a segment
+
+    Returns:
+        list: (start_frame, frame_count) of every segment, in order
+    """
+    count = min(workers, total_frames // max(1, min_frames))
+    if count <= 1:
+        return [(0, total_frames)]
+
+    starts = set()
+    for index in range(1, count):
+        target = round(total_frames * index / count)
+        if keyframes:
+            # Snap to the closest keyframe so seeking to the start of the segment doesn't decode anything extra
+            position = bisect.bisect_left(keyframes, target)
+            candidates = keyframes[max(0, position - 1) : position + 1]
+            target = min(candidates, key=lambda keyframe: abs(keyframe - target))
+        if 0 < target < total_frames:
+            starts.add(target)
+
+    bounds = [0] + sorted(starts) + [total_frames]
+    return [(start, end - start) for start, end in zip(bounds, bounds[1:])]
+
+
+def concat_segments(segment_files, output_file):
+    """Joins encoded segments into one fast-start video without re-encoding them"""
+    list_file = os.path.join(os.path.dirname(segment_files[0]), 'segments.txt')
+    with open(list_file, 'w', encoding='utf-8') as file:
+        file.writelines(f"file '{os.path.abspath(segment_file)}'\n" for segment_file in segment_files)
+    command = ['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', '-movflags', FAST_START_MOVFLAGS, output_file]
+    subprocess.run(command, check=True, capture_output=True)
+
+
+def process_segment(detect, input_file, segment_file, detections_folder, index, start_frame, frame_count, progress_queue, segment_cancel_event, threads=None):
+    """Runs a detection loop over one segment, inside a worker process, with `threads` torch threads when given
+
+    The loop stops with `JobCancelled` once `segment_cancel_event`, shared by all segments of the job, is set.
+    """
+    if threads:
+        # A worker process runs one segment at a time, so the process-wide count is the segment's own
+        cpu_budget.set_threads(threads)
+    cancel_event.set(segment_cancel_event)
+    pending = 0
+
+    def on_progress(frames):
+        nonlocal pending
+        pending += frames
+        if pending >= PROGRESS_REPORT_FRAMES:
+            progress_queue.put((index, pending))
+            pending = 0
+
+    stats = detect(input_file, segment_file, None, start_frame=start_frame, frame_count=frame_count, on_progress=on_progress, detections_folder=detections_folder)
+    if pending:
+        progress_queue.put((index, pending))
+    return stats
+
+
+def detect_in_segments(detect, input_file, output_file, segments_folder, detections_folder=None, on_progress=None, threads=None):
+    """
+    Processes a video as segments in parallel worker processes and stitches the annotated segments together.
+
+    Each segment gets its own inference backend and tracker state, so boxes are re-detected at segment starts.
+
+    Args:
+        detect (callable): Detection loop, e.g. `video_utils.detect_with_tracker`, must be picklable
+        input_file (str): Path of the input video
+        output_file (str): Path the annotated video is written to
+        segments_folder (str): Scratch folder for the annotated segments, removed afterwards
+        detections_folder (str): Folder the boxes of every frame are stored in, None to not store them
+        on_progress (callable): Called with the number of frames processed, across all segments
+        threads (int): Cores of the job, split between the segments processed at once, None to leave torch's defaults
+
+    Returns:
+        list: Stats returned by `detect` for every segment, in order
+    """
+    video = cv2.VideoCapture(input_file)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video.get(cv2.CAP_PROP_FPS) or 30
+    video.release()
+
+    segments = get_segments(total_frames, get_keyframe_indices(input_file, fps))
+    if len(segments) <= 1:
+        return [detect(input_file, output_file, None, on_progress=on_progress, detections_folder=detections_folder)]
+
+    os.makedirs(segments_folder, exist_ok=True)
+    segment_files = [os.path.join(segments_folder, f'segment_{index:03d}.mp4') for index in range(len(segments))]
+    segment_detections_folders = [os.path.join(segments_folder, f'detections_{index:03d}') if detections_folder else None for index in range(len(segments))]
+    logger.debug(f'Processing {input_file} as {len(segments)} segments: {segments}')
+
+    with multiprocessing.Manager() as manager:
+        progress_queue = manager.Queue()
+        segment_cancel_event = manager.Event()
+        reporter = threading.Thread(target=report_segment_progress, args=(progress_queue, segments, on_progress), daemon=True)
+        reporter.start()
+        try:
+            executor = get_segment_executor()
+            segment_threads = max(1, threads // min(len(segments), SEGMENT_WORKERS)) if threads else None
+            futures = [
+                executor.submit(process_segment, detect, input_file, segment_file, segment_detections_folder, index, start_frame, frame_count, progress_queue, segment_cancel_event, segment_threads)
+                for index, (segment_file, segment_detections_folder, (start_frame, frame_count)) in enumerate(zip(segment_files, segment_detections_folders, segments))
+            ]
+            wait_for_segments(futures, segment_cancel_event)
+            stats = [future.result() for future in futures]
+        finally:
+            progress_queue.put(None)
+            reporter.join()
+
+    concat_segments(segment_files, output_file)
+    if detections_folder:
+        merge_detection_stores(segment_detections_folders, detections_folder)
+    shutil.rmtree(segments_folder, ignore_errors=True)
+    return stats
+
+
+def wait_for_segments(futures, segment_cancel_event):
+    """Waits for every segment to finish, passing a cancellation of the job on to the worker processes
+
+    Segments not yet started are dropped, and the running ones are waited for, so no worker still writes the job's
+    files once this returns.
+    """
+    job_cancel_event = cancel_event.get()
+    pending = futures
+    while pending:
+        done, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_EXCEPTION)
+        errors = [future.exception() for future in done if future.exception() is not None]
+        if errors or (job_cancel_event is not None and job_cancel_event.is_set()):
+            # A failed segment fails the job, so the other segments are stopped as well
+            segment_cancel_event.set()
+            for future in pending:
+                future.cancel()
+            wait(pending)
+            raise_if_cancelled()
+            raise errors[0]
+
+
+def report_segment_progress(progress_queue, segments, on_progress=None):
+    """Collects progress from the segment workers until a None is received, logging every 10% of a segment"""
+    done = [0] * len(segments)
+    while True:
+        item = progress_queue.get()
+        if item is None:
+            return
+        index, frames = item
+        frame_count = segments[index][1]
+        previous_step = done[index] * 10 // frame_count
+        done[index] += frames
+        if done[index] * 10 // frame_count > previous_step:
+            logger.debug(f'Segment {index + 1}/{len(segments)}: {done[index]}/{frame_count} frames')
+        if on_progress:
+            on_progress(frames)
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from app.server.config.config import TRACKER_THREADS
+from app.server.utils.metrics_utils import stage_seconds
+
+# Shared by every job, OpenCV releases the GIL inside init/update so the trackers of a frame run in parallel
+tracker_executor = ThreadPoolExecutor(max_workers=max(1, TRACKER_THREADS), thread_name_prefix='tracker')
+
+
+def _create_tracker(frame, annotation):
+    label, score, xmin, ymin, xmax, ymax = annotation
+    tracker = cv2.TrackerCSRT_create()
+    tracker.init(frame, (xmin, ymin, xmax - xmin, ymax - ymin))
+    return [tracker, label, score]
+
+
+def create_trackers(frame, annotations, executor=tracker_executor):
+    """Creates a CSRT tracker for each annotated box, initialising them concurrently
+
+    Args:
+        frame (numpy.ndarray): The frame the boxes were detected on, without anything drawn on it
+        annotations (list): (label, score, xmin, ymin, xmax, ymax) tuples
+
+    Returns:
+        list: [tracker, label, score] for every annotation, in the same order
+    """
+    if len(annotations) < 2:
+        return [_create_tracker(frame, annotation) for annotation in annotations]
+    return list(executor.map(lambda annotation: _create_tracker(frame, annotation), annotations))
+
+
+def update_trackers(trackers, frame, executor=tracker_executor):
+    """Updates every tracker on the next frame concurrently
+
+    Args:
+        trackers (list): [tracker, label, score] entries
+        frame (numpy.ndarray): The next frame of the video
+
+    Returns:
+        list: (ret, bbox) as returned by each tracker's update, in the same order as `trackers`
+    """
+    with stage_seconds.time('tracker'):
+        if len(trackers) < 2:
+            return [tracker.update(frame) for tracker, _, _ in trackers]
+        return list(executor.map(lambda entry: entry[0].update(frame), trackers))
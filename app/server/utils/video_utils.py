@@ -1,30 +1,128 @@
 import cv2
-
-# import ffmpeg
+import numpy as np
 
 import time
 import os
+import shutil
+from collections import deque
+from functools import partial
 from bson import ObjectId
 
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
-
-from torchvision import transforms
-from detecto import core
 from tqdm import tqdm
-from detecto.utils import normalize_transform
 
-from app.server.static.constants import MEDIA_PATH, INPUT_FILE_PATH, OUTPUT_FILE_PATH
-from app.server.models.parsed_video import UpdateOutputVideoSuccess, UpdateOutputVideoError
+from app.server.config.config import (
+    DETECTION_STRIDE,
+    HLS_PREVIEW,
+    HLS_PREVIEW_KEEP,
+    INFERENCE_BATCH_SIZE,
+    INFERENCE_SIZE,
+    MOTION_GATE_INTERVAL,
+    MOTION_GATE_THRESHOLD,
+    SCENE_CHANGE_THRESHOLD,
+    SCORE_FILTER,
+    SEGMENT_WORKERS,
+    TRACKER_COUNT_FRAMES,
+)
+from app.server.static.constants import MEDIA_PATH, INPUT_FILE_PATH, OUTPUT_FILE_PATH, DETECTIONS_FOLDER_PATH, PREVIEW_FOLDER_PATH, SEGMENTS_FOLDER_PATH
+from app.server.models.parsed_video import DetectionParams, DetectionSettings, DetectionStats, UpdateOutputVideoSuccess, UpdateOutputVideoError
+from app.server.static.enums import DetectionMode, DetectionSource
 from app.server.config.databases import db
+from app.server.jobs.cpu_budget import apply_thread_budget, cpu_budget
+from app.server.jobs.job_cancel import JobCancelled
+from app.server.jobs.job_progress import ProgressTracker
+from app.server.jobs.job_queue import job_queue
+from app.server.logger.custom_logger import logger
 from app.server.utils.date_utils import get_formatted_time
+from app.server.utils.detection_utils import DetectionWriter
+from app.server.utils.encoder_utils import create_encoder
+from app.server.utils.inference_utils import inference_backend
+from app.server.utils.metrics_utils import job_seconds, stage_seconds
+from app.server.utils.motion_utils import MotionGate, get_frame_difference, get_thumbnail
+from app.server.utils.pipeline_utils import VideoPipeline, get_annotations
+from app.server.utils.segment_utils import detect_in_segments
+from app.server.utils.tracker_utils import create_trackers, update_trackers
 
 parsed_video_collection = db.get_collection('parsed_videos')
 
-model = core.Model.load('app/data/Train.pth', ['1', '2', '3', '4', '5'])
 
+def get_inference_dims(frame_width, frame_height, inference_size=INFERENCE_SIZE):
+    """Computes the frame size the detector runs at, keeping the aspect ratio
+
+    Args:
+        frame_width (int): Width of the source frames
+        frame_height (int): Height of the source frames
+        inference_size (int): Target length of the shorter side, 0 to keep full resolution
+
+    Returns:
+        tuple: (width, height) to resize frames to, or None when no downscaling is needed
+    """
+    if inference_size <= 0 or min(frame_height, frame_width) <= inference_size:
+        return None
+    scale_down_factor = min(frame_height, frame_width) / inference_size
+    return round(frame_width / scale_down_factor), round(frame_height / scale_down_factor)
+
+
+def predict_frames(model, frames, inference_size=INFERENCE_SIZE):
+    """Runs the detector over a batch of frames in a single forward pass
+
+    Frames are downscaled with OpenCV so their shorter side is `inference_size` pixels,
+    and the predicted boxes are mapped back to source-frame coordinates. The model's own resize is
+    set to the same size (`engine_utils.set_input_size`), so the backbone runs at it too.
 
-def detect_video(input_file, output_file, temp_file, model=model, fps=30, score_filter=0.6):
+    Args:
+        model: Inference backend, see `inference_utils.create_inference_backend`
+        frames (list): Frames to run detection on, all of the same size
+        inference_size (int): Shorter side the frames are downscaled to, 0 to keep full resolution
+
+    Returns:
+        list: One (labels, boxes, scores) tuple per frame, in the same order as `frames`
+    """
+    if not frames:
+        return []
+    # The job's share of the cores changes as other jobs start and finish, and each thread has to apply it itself
+    apply_thread_budget()
+    start_time = time.perf_counter()
+    try:
+        return _predict_frames(model, frames, inference_size)
+    finally:
+        # Every frame of the batch is charged an equal share of the forward pass
+        stage_seconds.observe((time.perf_counter() - start_time) / len(frames), 'inference', count=len(frames))
+
+
+def _predict_frames(model, frames, inference_size):
+    frame_height, frame_width = frames[0].shape[:2]
+    inference_dims = get_inference_dims(frame_width, frame_height, inference_size)
+    if inference_dims is None:
+        # A list is a batch and gets one prediction per image back
+        return model.predict(list(frames))
+
+    # INTER_AREA is the cheapest resize that doesn't alias when shrinking
+    scaled_frames = [cv2.resize(frame, inference_dims, interpolation=cv2.INTER_AREA) for frame in frames]
+    batch_predictions = model.predict(scaled_frames)
+
+    # Since the predictions are for scaled down frames, we need to increase the box dimensions
+    scale_x, scale_y = frame_width / inference_dims[0], frame_height / inference_dims[1]
+    scale = np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+    return [(labels, boxes * scale, scores) for labels, boxes, scores in batch_predictions]
+
+
+def detect_video(
+    input_file,
+    output_file,
+    temp_file,
+    model=None,
+    fps=30,
+    score_filter=SCORE_FILTER,
+    batch_size=INFERENCE_BATCH_SIZE,
+    inference_size=INFERENCE_SIZE,
+    motion_threshold=MOTION_GATE_THRESHOLD,
+    motion_interval=MOTION_GATE_INTERVAL,
+    start_frame=0,
+    frame_count=None,
+    on_progress=None,
+    preview_folder=None,
+    detections_folder=None,
+):
     """Takes in a video and produces an output video with object detection
     run on it (i.e. displays boxes around detected objects in real-time).
     Output videos should have the .avi file extension. Note: some apps,
@@ -33,8 +131,9 @@ def detect_video(input_file, output_file, temp_file, model=model, fps=30, score_
     `VLC <https://www.videolan.org/vlc/index.html>`_ if this occurs.
 
 
-    :param model: The trained model with which to run object detection.
-    :type model: detecto.core.Model
+    :param model: (Optional) The inference backend with which to run object
+        detection. Defaults to the one selected by ``INFERENCE_BACKEND``.
+    :type model: inference_utils.LocalInferenceBackend
     :param input_file: The path to the input video.
     :type input_file: str
     :param output_file: The name of the output file. Should have a .avi
@@ -46,6 +145,40 @@ def detect_video(input_file, output_file, temp_file, model=model, fps=30, score_
     :param score_filter: (Optional) Minimum score required to show a
         prediction. Defaults to 0.6.
     :type score_filter: float
+    :param batch_size: (Optional) Number of frames run through the model
+        in one forward pass. Defaults to ``INFERENCE_BATCH_SIZE``.
+    :type batch_size: int
+    :param inference_size: (Optional) Shorter side, in pixels, frames are
+        scaled down to before detection; 0 runs at full resolution.
+        Defaults to ``INFERENCE_SIZE``.
+    :type inference_size: int
+    :param motion_threshold: (Optional) Frame difference (0-1) between a
+        downscaled grayscale frame and the last detected one below which the
+        frame reuses its boxes instead of running the detector, see
+        ``motion_utils.MotionGate``; 0 detects every frame. Defaults to
+        ``MOTION_GATE_THRESHOLD``.
+    :type motion_threshold: float
+    :param motion_interval: (Optional) Most frames in a row that can reuse
+        boxes before the detector runs again. Defaults to
+        ``MOTION_GATE_INTERVAL``.
+    :type motion_interval: int
+    :param start_frame: (Optional) First frame to process. Defaults to 0.
+    :type start_frame: int
+    :param frame_count: (Optional) Number of frames to process from
+        `start_frame`. Defaults to the rest of the video.
+    :type frame_count: int
+    :param on_progress: (Optional) Called with the number of frames
+        processed each time a batch is handed to the encoder.
+    :type on_progress: callable
+    :param preview_folder: (Optional) Folder a live HLS preview of the
+        annotated video is written to while it's processed.
+    :type preview_folder: str
+    :param detections_folder: (Optional) Folder the boxes of every frame
+        are stored in, see ``detection_utils.DetectionWriter``.
+    :type detections_folder: str
+    :return: Counts of frames that went through the detector and of frames
+        that reused boxes.
+    :rtype: DetectionStats
 
     **Example**::
 
@@ -56,6 +189,10 @@ def detect_video(input_file, output_file, temp_file, model=model, fps=30, score_
         >>> detect_video(model, 'input_vid.mp4', 'output_vid.avi', score_filter=0.7)
     """
 
+    # Run the configured inference backend, a local model is loaded on first use rather than at import time
+    if model is None:
+        model = inference_backend
+
     # Read in the video
     video = cv2.VideoCapture(input_file)
 
@@ -63,74 +200,79 @@ def detect_video(input_file, output_file, temp_file, model=model, fps=30, score_
     frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-    # Scale down frames when passing into model for faster speeds
-    scaled_size = 800
-    scale_down_factor = min(frame_height, frame_width) / scaled_size
+    # The encoder with which we'll write our video with the boxes and labels
+    out = create_encoder(output_file, fps, (frame_width, frame_height), preview_folder)
 
-    # The VideoWriter with which we'll write our video with the boxes and labels
-    # Parameters: filename, fourcc, fps, frame_size
-    out = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_width, frame_height))
+    total_frames = frame_count or int(video.get(cv2.CAP_PROP_FRAME_COUNT)) - start_frame
 
-    # Transform to apply on individual frames of the video
-    transform_frame = transforms.Compose([transforms.ToPILImage(), transforms.Resize(scaled_size), transforms.ToTensor(), normalize_transform()])  # TODO Issue #16
-
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    # Boxes are stored against the source frame rate, so they line up with timestamps of the input video
+    store = DetectionWriter(detections_folder, start_frame, video.get(cv2.CAP_PROP_FPS) or fps) if detections_folder else None
 
     # Create a tqdm progress bar with the total number of frames
     pbar = tqdm(total=total_frames, desc='Processing Frames')
 
     # tracker = cv2.Tracker_create(args["tracker"].upper())
-
-    # Loop through every frame of the video
-    while True:
-        # start_time = time.time()
-        ret, frame = video.read()
-        # Stop the loop when we're done with the video
-        if not ret:
-            break
-
-        # The transformed frame is what we'll feed into our model
-        # transformed_frame = transform_frame(frame)
-        transformed_frame = frame  # TODO: Issue #16
-        predictions = model.predict(transformed_frame)
-
-        # Add the top prediction of each class to the frame
-        for label, box, score in zip(*predictions):
-            if score < score_filter:
-                continue
-
-            # Since the predictions are for scaled down frames,
-            # we need to increase the box dimensions
-            # box *= scale_down_factor  # TODO Issue #16
-
-            # Create the box around each object detected
-            # Parameters: frame, (start_x, start_y), (end_x, end_y), (r, g, b), thickness
-            xmin, ymin, xmax, ymax = int(box[0]), int(box[1]), int(box[2]), int(box[3])
-            cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)  # Green rectangle
-
-            cv2.putText(frame, f'{label}: {round(score.item(), 2)}', (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 3)
-
-        # Write this frame to our video file
-        out.write(frame)
-        pbar.update(1)
-        # print(f'\nThis much time for a frame: {time.time() - start_time}\n')
-
-        # If the 'q' key is pressed, break from the loop
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
-            break
+    detector_frames = 0
+    reused_frames = 0
+
+    # Frames that barely changed since the last detected one keep its boxes, when gating is on
+    gate = MotionGate(motion_threshold, motion_interval) if motion_threshold > 0 else None
+    annotations = []
+
+    # Decoding and encoding run on their own threads while this one runs the model
+    with VideoPipeline(video, out, start_frame, frame_count, store) as pipeline:
+        # Loop through the video a batch of frames at a time
+        while True:
+            frames = pipeline.read_frames(batch_size)
+            # Stop the loop when we're done with the video
+            if not frames:
+                break
+
+            # Only the frames the gate lets through go to the model, still in a single forward pass
+            detect_indices = [index for index, frame in enumerate(frames) if gate is None or gate.should_detect(frame)]
+            # Frames are scaled down for the model and the boxes come back in frame coordinates
+            batch_predictions = predict_frames(model, [frames[index] for index in detect_indices], inference_size)
+            batch_annotations = {index: get_annotations(predictions, score_filter) for index, predictions in zip(detect_indices, batch_predictions)}
+
+            # Hand every frame with its boxes to the annotate stage, in the order it was read
+            for index, frame in enumerate(frames):
+                if index in batch_annotations:
+                    annotations = batch_annotations[index]
+                    pipeline.write(frame, annotations)
+                else:
+                    pipeline.write(frame, annotations, DetectionSource.REUSED)
+            detector_frames += len(detect_indices)
+            reused_frames += len(frames) - len(detect_indices)
+            pbar.update(len(frames))
+            if on_progress:
+                on_progress(len(frames))
 
     # When finished, release the video capture and writer objects
     video.release()
     out.release()
+    return get_detection_stats(detector_frames, 0, reused_frames)
+
+
+def detect_with_tracker(
+    input_file,
+    output_file,
+    temp_file,
+    model=None,
+    fps=30,
+    score_filter=SCORE_FILTER,
+    batch_size=INFERENCE_BATCH_SIZE,
+    inference_size=INFERENCE_SIZE,
+    count_until=TRACKER_COUNT_FRAMES,
+    start_frame=0,
+    frame_count=None,
+    on_progress=None,
+    preview_folder=None,
+    detections_folder=None,
+):
+    # Run the configured inference backend, a local model is loaded on first use rather than at import time
+    if model is None:
+        model = inference_backend
 
-    # Close all the frames
-    cv2.destroyAllWindows()
-    # ffmpeg.input(temp_file).output(output_file).run()
-    # os.remove(temp_file)
-
-
-def detect_with_tracker(input_file, output_file, temp_file, model=model, fps=30, score_filter=0.6):
     # Read in the video
     video = cv2.VideoCapture(input_file)
 
@@ -138,18 +280,13 @@ def detect_with_tracker(input_file, output_file, temp_file, model=model, fps=30,
     frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-    # Scale down frames when passing into model for faster speeds
-    scaled_size = 800
-    scale_down_factor = min(frame_height, frame_width) / scaled_size
+    # The encoder with which we'll write our video with the boxes and labels
+    out = create_encoder(output_file, fps, (frame_width, frame_height), preview_folder)
 
-    # The VideoWriter with which we'll write our video with the boxes and labels
-    # Parameters: filename, fourcc, fps, frame_size
-    out = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_width, frame_height))
+    total_frames = frame_count or int(video.get(cv2.CAP_PROP_FRAME_COUNT)) - start_frame
 
-    # Transform to apply on individual frames of the video
-    transform_frame = transforms.Compose([transforms.ToPILImage(), transforms.Resize(scaled_size), transforms.ToTensor(), normalize_transform()])  # TODO Issue #16
-
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    # Boxes are stored against the source frame rate, so they line up with timestamps of the input video
+    store = DetectionWriter(detections_folder, start_frame, video.get(cv2.CAP_PROP_FPS) or fps) if detections_folder else None
 
     # Create a tqdm progress bar with the total number of frames
     pbar = tqdm(total=total_frames, desc='Processing Frames')
@@ -158,116 +295,285 @@ def detect_with_tracker(input_file, output_file, temp_file, model=model, fps=30,
     trackers = []
     num_objects = -1
     max_cnt = 0
-    COUNT_UNTIL = 3
+    COUNT_UNTIL = max(1, count_until)
     cur_cnt = 0
-
-    while True:
-        ret, frame = video.read()
-        if not ret:
-            break
-
-        # Run object detection until 5 objects are detected
-        if num_objects == -1:
-            # print("Counting Objects")
-            transformed_frame = frame  # TODO: Apply transformation
-            predictions = model.predict(transformed_frame)
-            cnt = 0
-
-            # Initialize trackers for up to 5 detected objects
-            for label, box, score in zip(*predictions):
-                if score < score_filter:
-                    continue
-                bbox = (int(box[0]), int(box[1]), int(box[2] - box[0]), int(box[3] - box[1]))
-
-                ## draw rectangle
-                cv2.rectangle(frame, (bbox[0], bbox[1]), (bbox[0] + bbox[2], bbox[1] + bbox[3]), (0, 255, 0), 2)  # Green rectangle
-                cv2.putText(frame, f'{label}: {round(score.item(), 2)}', (bbox[0], bbox[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 3)
-
-                cnt += 1
-
-            max_cnt = max(max_cnt, cnt)
-            cur_cnt += 1
-
-            if cur_cnt >= COUNT_UNTIL:
-                #   print("Objects Found: ",max_cnt)
-                num_objects = max_cnt
-                cur_cnt = 0
-                max_cnt = 0
-        elif len(trackers) < num_objects:
-            trackers = []
-
-            transformed_frame = frame  # TODO: Apply transformation
-            predictions = model.predict(transformed_frame)
-
-            # Initialize trackers for up to 5 detected objects
-            for label, box, score in zip(*predictions):
-                if score < score_filter:
-                    continue
-                bbox = (int(box[0]), int(box[1]), int(box[2] - box[0]), int(box[3] - box[1]))
-
-                ## draw rectangle
-                cv2.rectangle(frame, (bbox[0], bbox[1]), (bbox[0] + bbox[2], bbox[1] + bbox[3]), (0, 255, 0), 2)  # Green rectangle
-                cv2.putText(frame, f'{label}: {round(score.item(), 2)}', (bbox[0], bbox[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 3)
-
-                ## create tracker for this object
-                tracker = cv2.TrackerCSRT_create()
-                tracker.init(frame, bbox)
-                trackers.append([tracker, label, score.item()])
-                if len(trackers) == num_objects:
+    detector_frames = 0
+    tracker_frames = 0
+
+    # Frames read ahead together with their batched predictions
+    pending = deque()
+
+    # Decoding and encoding run on their own threads while this one runs the model and trackers
+    with VideoPipeline(video, out, start_frame, frame_count, store) as pipeline:
+        while True:
+            if not pending:
+                # While counting, the next COUNT_UNTIL - cur_cnt frames are known to need the detector, so they
+                # are predicted together in one batch. The frame after them is only predicted, on its own, when
+                # the count found objects to track
+                lookahead = min(batch_size, COUNT_UNTIL - cur_cnt) if num_objects == -1 else 1
+                frames = pipeline.read_frames(lookahead)
+                if not frames:
                     break
-            # print("Objects Detected: ",len(trackers))
-        else:
-            # Update existing trackers
-            flag = 1
-            for tracker, label, score in trackers:
-                ret, bbox = tracker.update(frame)
-                if not ret:
-                    # If tracker fails, reset all trackers and break
-                    flag = 0
-                else:
-                    # Tracking successful, draw bounding box
-                    xmin, ymin, w, h = (int(coord) for coord in bbox)
-                    cv2.rectangle(frame, (xmin, ymin), (xmin + w, ymin + h), (0, 255, 0), 2)
-                    cv2.putText(frame, f'{label}: {round(score, 2)}', (xmin, ymin - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 3)
-
-            if flag == 0:
-                #   print("Tracking failed")
+                batch_predictions = predict_frames(model, frames, inference_size) if len(frames) > 1 else [None]
+                pending.extend(zip(frames, batch_predictions))
+            frame, predictions = pending.popleft()
+            annotations = []
+            source = DetectionSource.DETECTOR
+
+            # Run object detection until 5 objects are detected
+            if num_objects == -1:
+                # print("Counting Objects")
+                if predictions is None:
+                    predictions = predict_frames(model, [frame], inference_size)[0]
+                annotations = get_annotations(predictions, score_filter)
+                detector_frames += 1
+
+                max_cnt = max(max_cnt, len(annotations))
+                cur_cnt += 1
+
+                if cur_cnt >= COUNT_UNTIL:
+                    #   print("Objects Found: ",max_cnt)
+                    num_objects = max_cnt
+                    cur_cnt = 0
+                    max_cnt = 0
+            elif len(trackers) < num_objects:
                 trackers = []
-                num_objects = -1
-                cur_cnt = 0
-                max_cnt = 0
 
-        # Write frame to video
-        out.write(frame)
-        pbar.update(1)
+                if predictions is None:
+                    predictions = predict_frames(model, [frame], inference_size)[0]
+                detector_frames += 1
+
+                # Initialize trackers for up to num_objects detected objects,
+                # on the frame before any boxes are drawn on it
+                annotations = get_annotations(predictions, score_filter)[:num_objects]
+                trackers = create_trackers(frame, annotations)
+                # print("Objects Detected: ",len(trackers))
+            else:
+                # Update existing trackers
+                tracker_frames += 1
+                source = DetectionSource.TRACKER
+                flag = 1
+                # All trackers of the frame are updated concurrently, results come back in tracker order
+                for (_, label, score), (ret, bbox) in zip(trackers, update_trackers(trackers, frame)):
+                    if not ret:
+                        # If tracker fails, reset all trackers and break
+                        flag = 0
+                    else:
+                        # Tracking successful, draw bounding box
+                        xmin, ymin, w, h = (int(coord) for coord in bbox)
+                        annotations.append((label, score, xmin, ymin, xmin + w, ymin + h))
+
+                if flag == 0:
+                    #   print("Tracking failed")
+                    trackers = []
+                    num_objects = -1
+                    cur_cnt = 0
+                    max_cnt = 0
+
+            # Write frame to video
+            pipeline.write(frame, annotations, source)
+            pbar.update(1)
+            if on_progress:
+                on_progress(1)
 
-        # Exit loop if 'q' key is pressed
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
-            break
+    # Release resources
+    video.release()
+    out.release()
+    return get_detection_stats(detector_frames, tracker_frames)
+
+
+def detect_with_stride(
+    input_file,
+    output_file,
+    temp_file,
+    model=None,
+    fps=30,
+    score_filter=SCORE_FILTER,
+    inference_size=INFERENCE_SIZE,
+    stride=DETECTION_STRIDE,
+    scene_change_threshold=SCENE_CHANGE_THRESHOLD,
+    start_frame=0,
+    frame_count=None,
+    on_progress=None,
+    preview_folder=None,
+    detections_folder=None,
+):
+    """Runs the detector every `stride` frames and propagates its boxes with CSRT trackers in between.
+
+    Detection is also forced early when a tracker loses its object or when the frame differs from the
+    previous one by more than `scene_change_threshold` (a cut or a sudden camera move), since trackers
+    initialised on the old scene would follow the wrong pixels.
+
+    :param stride: (Optional) Run the detector every this many frames.
+        Defaults to ``DETECTION_STRIDE``.
+    :type stride: int
+    :param scene_change_threshold: (Optional) Mean absolute difference
+        (0-1) between consecutive downscaled grayscale frames that forces
+        re-detection. Defaults to ``SCENE_CHANGE_THRESHOLD``.
+    :type scene_change_threshold: float
+    :return: Counts of frames that went through the detector and the trackers.
+    :rtype: DetectionStats
+    """
+    # Run the configured inference backend, a local model is loaded on first use rather than at import time
+    if model is None:
+        model = inference_backend
+
+    # Read in the video
+    video = cv2.VideoCapture(input_file)
+
+    # Video frame dimensions
+    frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    # The encoder with which we'll write our video with the boxes and labels
+    out = create_encoder(output_file, fps, (frame_width, frame_height), preview_folder)
+
+    total_frames = frame_count or int(video.get(cv2.CAP_PROP_FRAME_COUNT)) - start_frame
+
+    # Boxes are stored against the source frame rate, so they line up with timestamps of the input video
+    store = DetectionWriter(detections_folder, start_frame, video.get(cv2.CAP_PROP_FPS) or fps) if detections_folder else None
+
+    # Create a tqdm progress bar with the total number of frames
+    pbar = tqdm(total=total_frames, desc='Processing Frames')
+
+    trackers = []
+    frames_since_detection = stride
+    previous_thumbnail = None
+    detector_frames = 0
+    tracker_frames = 0
+
+    with VideoPipeline(video, out, start_frame, frame_count, store) as pipeline:
+        while True:
+            frames = pipeline.read_frames(1)
+            if not frames:
+                break
+            frame = frames[0]
+            annotations = []
+
+            thumbnail = get_thumbnail(frame)
+            scene_changed = get_frame_difference(previous_thumbnail, thumbnail) > scene_change_threshold
+            previous_thumbnail = thumbnail
+
+            tracking_failed = False
+            if frames_since_detection < stride and not scene_changed:
+                # Move every box along with its tracker, all trackers of the frame are updated concurrently
+                for (_, label, score), (ret, bbox) in zip(trackers, update_trackers(trackers, frame)):
+                    if not ret:
+                        tracking_failed = True
+                        break
+                    xmin, ymin, w, h = (int(coord) for coord in bbox)
+                    annotations.append((label, score, xmin, ymin, xmin + w, ymin + h))
+
+            if frames_since_detection >= stride or scene_changed or tracking_failed:
+                predictions = predict_frames(model, [frame], inference_size)[0]
+                annotations = get_annotations(predictions, score_filter)
+                trackers = create_trackers(frame, annotations)
+                frames_since_detection = 0
+                detector_frames += 1
+                source = DetectionSource.DETECTOR
+            else:
+                tracker_frames += 1
+                source = DetectionSource.TRACKER
+
+            frames_since_detection += 1
+            pipeline.write(frame, annotations, source)
+            pbar.update(1)
+            if on_progress:
+                on_progress(1)
 
     # Release resources
     video.release()
     out.release()
-    cv2.destroyAllWindows()
-    # ffmpeg.input(temp_file).output(output_file).run()
-    # os.remove(temp_file)
+    return get_detection_stats(detector_frames, tracker_frames)
+
+
+def get_detection_stats(detector_frames, tracker_frames, reused_frames=0):
+    """Summarises how many frames were detected, tracked and reused
+
+    Args:
+        detector_frames (int): Frames the detector ran on
+        tracker_frames (int): Frames whose boxes came only from trackers
+        reused_frames (int): Frames that kept the boxes of the last detected frame
+
+    Returns:
+        DetectionStats: Frame counts and their share of the whole video
+    """
+    total_frames = detector_frames + tracker_frames + reused_frames
+    if total_frames == 0:
+        return DetectionStats()
+    return DetectionStats(
+        totalFrames=total_frames,
+        detectorFrames=detector_frames,
+        trackerFrames=tracker_frames,
+        reusedFrames=reused_frames,
+        detectorRatio=detector_frames / total_frames,
+        trackerRatio=tracker_frames / total_frames,
+        reusedRatio=reused_frames / total_frames,
+    )
+
+
+def get_frame_count(input_file):
+    """Reads the number of frames from the container header, without decoding the video"""
+    video = cv2.VideoCapture(input_file)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    return max(0, total_frames)
+
+
+def merge_detection_stats(stats_list):
+    """Adds up the stats of the segments of a video"""
+    return get_detection_stats(sum(stats.detectorFrames for stats in stats_list), sum(stats.trackerFrames for stats in stats_list), sum(stats.reusedFrames for stats in stats_list))
 
 
-async def detect_video_and_set_db(entry_id):
+def get_detection_function(params: DetectionParams):
+    """Picks the detection loop for a job and binds its per-job parameters"""
+    if params.mode == DetectionMode.DETECTOR:
+        return partial(detect_video, motion_threshold=params.motionThreshold, motion_interval=params.motionInterval)
+    if params.mode == DetectionMode.STRIDED:
+        return partial(detect_with_stride, stride=params.stride, scene_change_threshold=params.sceneChangeThreshold)
+    return detect_with_tracker
+
+
+async def detect_video_and_set_db(entry_id, params: DetectionParams):
     input_file = os.path.join('app/', MEDIA_PATH, entry_id, INPUT_FILE_PATH)
     output_file = os.path.join('app/', MEDIA_PATH, entry_id, OUTPUT_FILE_PATH)
     temp_file = os.path.join('app/', MEDIA_PATH, entry_id, 'temp.mp4')
+    segments_folder = os.path.join('app/', MEDIA_PATH, entry_id, SEGMENTS_FOLDER_PATH)
+    preview_folder = os.path.join('app/', MEDIA_PATH, entry_id, PREVIEW_FOLDER_PATH) if HLS_PREVIEW else None
+    detections_folder = os.path.join('app/', MEDIA_PATH, entry_id, DETECTIONS_FOLDER_PATH)
     update_data = None
+    start_time = time.time()
     try:
-        start_time = time.time()
-        with ThreadPoolExecutor() as executor:
-            await asyncio.get_event_loop().run_in_executor(executor, detect_with_tracker, input_file, output_file, temp_file)
+        progress = ProgressTracker(entry_id, await job_queue.run_blocking(get_frame_count, input_file))
+        await progress.start()
+        detect = get_detection_function(params)
+        try:
+            with logger.contextualize(stage='detect'):
+                if SEGMENT_WORKERS > 1:
+                    # Split the video at keyframes and process the segments in parallel worker processes, sharing the job's current cores
+                    segment_stats = await job_queue.run_blocking(
+                        partial(detect_in_segments, on_progress=progress.update, threads=cpu_budget.threads), detect, input_file, output_file, segments_folder, detections_folder
+                    )
+                    stats = merge_detection_stats(segment_stats)
+                else:
+                    # The live preview is served from /media/<entry_id>/preview/index.m3u8 while the job runs
+                    stats = await job_queue.run_blocking(
+                        partial(detect, on_progress=progress.update, preview_folder=preview_folder, detections_folder=detections_folder), input_file, output_file, temp_file
+                    )
+        finally:
+            await progress.stop()
         # await detect_video(input_file=input_file, output_file=output_file)
         duration = get_formatted_time(time.time() - start_time)
-        update_data = UpdateOutputVideoSuccess(runtime=duration)
+        update_data = UpdateOutputVideoSuccess(runtime=duration, stats=stats, detectionSettings=DetectionSettings())
+    except JobCancelled:
+        # The video is handed back to be processed again, not failed
+        raise
     except Exception as e:
-        print(e)
+        logger.error(f'Detection failed: {e}')
         update_data = UpdateOutputVideoError()
+    job_seconds.observe(time.time() - start_time, params.mode.value, update_data.status.value)
     updated_entry = await parsed_video_collection.find_one_and_update({'_id': ObjectId(entry_id)}, {'$set': update_data.dict()})
+    if preview_folder and not HLS_PREVIEW_KEEP:
+        # Clients move from the preview to the final video once the entry is no longer in-process
+        await job_queue.run_blocking(partial(shutil.rmtree, preview_folder, ignore_errors=True))
     return updated_entry
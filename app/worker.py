@@ -0,0 +1,42 @@
+"""
+Entry point of a worker process, which processes videos uploaded through API-only processes.
+
+Run with `APP_ROLE=worker python -m app.worker` next to API processes started with `APP_ROLE=api`.
+Both must share the media folder and the Mongo database.
+"""
+import asyncio
+import signal
+
+from app.server.http_client.http_client import http_client_pool
+from app.server.jobs.job_poller import poll_parsed_videos, release_parsed_videos
+from app.server.jobs.job_queue import job_queue
+from app.server.logger.custom_logger import logger
+from app.server.utils import date_utils, mongo_utils
+from app.server.utils.inference_utils import inference_backend
+
+
+async def run_worker():
+    logger.debug(f'Worker startup: {str(date_utils.get_current_datetime())}')
+    # docker stop and Kubernetes send SIGTERM, which would otherwise end the process without handing its videos back
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, main_task.cancel)
+    await mongo_utils.create_indexes()
+    # Only start claiming videos once the model is warm
+    await loop.run_in_executor(None, inference_backend.warm_up)
+    await http_client_pool.start()
+    await job_queue.start()
+    try:
+        await poll_parsed_videos()
+    finally:
+        await release_parsed_videos(await job_queue.stop())
+        await http_client_pool.stop()
+        logger.debug(f'Worker shutdown: {str(date_utils.get_current_datetime())}')
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(run_worker())
+    except asyncio.CancelledError:
+        logger.debug('Worker stopped by a signal')
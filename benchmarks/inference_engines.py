@@ -0,0 +1,234 @@
+"""
+Compares the inference engines of the model with the eager detecto model: speed, and how far their predictions move.
+
+Frames are sampled evenly from the clips, downscaled like the video pipeline does (`INFERENCE_SIZE`) and run through
+every engine in batches of `INFERENCE_BATCH_SIZE`. Predictions of the eager model are the reference: boxes of another
+engine match one of its boxes of the same label with an IoU of at least `--iou`, counting only boxes above `--score-filter`.
+
+Export the artifacts first (`python -m app.export_model`, with `--quantize` for the int8 variants), or pass `--export`.
+Run from the repository root, e.g.
+
+    python -m benchmarks.inference_engines --input clip1.mp4 clip2.mp4 --output engines.json
+    python -m benchmarks.inference_engines --engines eager,onnx,onnx-int8 --export
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from app.server.config.config import INFERENCE_BATCH_SIZE, INFERENCE_SIZE, MODEL_CLASSES, MODEL_PATH
+from app.server.utils.engine_utils import export_model, get_engine_path
+from app.server.utils.inference_utils import to_numpy_prediction
+from app.server.utils.model_utils import ModelLoader
+from app.server.utils.video_utils import get_inference_dims
+from benchmarks.synthetic import generate_video
+
+ENGINES = ('eager', 'eager-int8', 'torchscript', 'torchscript-int8', 'onnx', 'onnx-int8')
+
+
+def parse_engine(name):
+    """Splits an engine name of the command line, e.g. onnx-int8, into (engine, quantize)"""
+    engine, _, variant = name.partition('-')
+    return engine, variant == 'int8'
+
+
+def read_frames(input_files, frames_per_clip, inference_size):
+    """Decodes `frames_per_clip` evenly spaced frames of every clip, downscaled to the size the detector runs at"""
+    frames = []
+    for input_file in input_files:
+        video = cv2.VideoCapture(input_file)
+        total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        for position in np.linspace(0, max(0, total_frames - 1), min(frames_per_clip, total_frames)).astype(int):
+            video.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+            ret, frame = video.read()
+            if not ret:
+                continue
+            inference_dims = get_inference_dims(frame.shape[1], frame.shape[0], inference_size)
+            frames.append(frame if inference_dims is None else cv2.resize(frame, inference_dims, interpolation=cv2.INTER_AREA))
+        video.release()
+    return frames
+
+
+def get_iou(box, other):
+    width = min(box[2], other[2]) - max(box[0], other[0])
+    height = min(box[3], other[3]) - max(box[1], other[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (box[2] - box[0]) * (box[3] - box[1]) + (other[2] - other[0]) * (other[3] - other[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def filter_prediction(prediction, score_filter):
+    labels, boxes, scores = prediction
+    return [(label, np.asarray(box, dtype=np.float32), float(score)) for label, box, score in zip(labels, boxes, scores) if score >= score_filter]
+
+
+def match_predictions(reference, candidate, iou_threshold):
+    """Greedily pairs every reference box with the best overlapping candidate box of the same label
+
+    Returns:
+        list: (iou, reference score, candidate score) of every pair
+    """
+    matches = []
+    used = set()
+    for label, box, score in sorted(reference, key=lambda detection: -detection[2]):
+        best_index, best_iou = None, iou_threshold
+        for index, (other_label, other_box, _) in enumerate(candidate):
+            if index in used or other_label != label:
+                continue
+            iou = get_iou(box, other_box)
+            if iou >= best_iou:
+                best_index, best_iou = index, iou
+        if best_index is not None:
+            used.add(best_index)
+            matches.append((best_iou, score, candidate[best_index][2]))
+    return matches
+
+
+def compare_predictions(reference_predictions, predictions, score_filter, iou_threshold):
+    """Agreement of an engine's predictions with the eager model's, over all frames"""
+    reference_count = candidate_count = 0
+    matches = []
+    for reference, candidate in zip(reference_predictions, predictions):
+        reference = filter_prediction(reference, score_filter)
+        candidate = filter_prediction(candidate, score_filter)
+        reference_count += len(reference)
+        candidate_count += len(candidate)
+        matches.extend(match_predictions(reference, candidate, iou_threshold))
+    return {
+        'referenceBoxes': reference_count,
+        'boxes': candidate_count,
+        # Share of the eager model's boxes the engine finds too, and share of the engine's boxes the eager model agrees with
+        'recall': len(matches) / reference_count if reference_count else 1.0,
+        'precision': len(matches) / candidate_count if candidate_count else 1.0,
+        'meanIou': statistics.mean(match[0] for match in matches) if matches else None,
+        'meanScoreDelta': statistics.mean(abs(match[1] - match[2]) for match in matches) if matches else None,
+    }
+
+
+def measure(model, frames, batch_size, repeat):
+    """Runs every frame through the model `repeat` times
+
+    Returns:
+        tuple: (predictions of the last pass, milliseconds per frame of every pass)
+    """
+    timings = []
+    for _ in range(repeat):
+        predictions = []
+        start_time = time.perf_counter()
+        for offset in range(0, len(frames), batch_size):
+            predictions.extend(model.predict(frames[offset : offset + batch_size]))
+        timings.append(1000 * (time.perf_counter() - start_time) / len(frames))
+    return predictions, timings
+
+
+def run_benchmark(options):
+    batch_size = options['batch_size'] or INFERENCE_BATCH_SIZE
+    inference_size = INFERENCE_SIZE if options['inference_size'] is None else options['inference_size']
+    with tempfile.TemporaryDirectory() as work_folder:
+        input_files = options['input'] or [generate_video(os.path.join(work_folder, 'input.mp4'), frame_count=options['frames_per_clip'])]
+        frames = read_frames(input_files, options['frames_per_clip'], inference_size)
+    if not frames:
+        raise SystemExit('No frames could be read from the clips')
+
+    engines = {}
+    reference_predictions = None
+    # The eager model always runs first, it's the reference of the others
+    for name in ['eager'] + [name for name in options['engines'] if name != 'eager']:
+        engine, quantize = parse_engine(name)
+        if engine != 'eager' and not os.path.exists(get_engine_path(MODEL_PATH, engine, quantize)):
+            if not options['export']:
+                print(f'{name}: skipped, {get_engine_path(MODEL_PATH, engine, quantize)} not found', file=sys.stderr)
+                engines[name] = {'skipped': 'not exported'}
+                continue
+            export_model(MODEL_PATH, MODEL_CLASSES, engine, quantize)
+
+        loader = ModelLoader(MODEL_PATH, MODEL_CLASSES, engine, quantize)
+        start_time = time.perf_counter()
+        loader.warm_up()
+        load_seconds = time.perf_counter() - start_time
+        predictions, timings = measure(loader.get(), frames, batch_size, options['repeat'])
+        predictions = [to_numpy_prediction(prediction) for prediction in predictions]
+
+        ms_per_frame = statistics.median(timings)
+        engines[name] = {'loadSeconds': load_seconds, 'msPerFrame': ms_per_frame, 'fps': 1000 / ms_per_frame, 'runsMsPerFrame': timings}
+        if reference_predictions is None:
+            reference_predictions = predictions
+        else:
+            engines[name]['speedup'] = engines['eager']['msPerFrame'] / ms_per_frame
+            engines[name]['accuracy'] = compare_predictions(reference_predictions, predictions, options['score_filter'], options['iou'])
+        print(format_engine(name, engines[name]), file=sys.stderr)
+
+    return {'meta': get_meta(options, input_files, len(frames), batch_size, inference_size), 'engines': engines}
+
+
+def format_engine(name, result):
+    line = f'{name}: {result["msPerFrame"]:.1f} ms/frame'
+    if 'accuracy' in result:
+        accuracy = result['accuracy']
+        line += f', {result["speedup"]:.2f}x eager, recall {accuracy["recall"]:.3f}, precision {accuracy["precision"]:.3f}'
+    return line
+
+
+def get_meta(options, input_files, frame_count, batch_size, inference_size):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'clips': input_files if options['input'] else ['synthetic'],
+        'frames': frame_count,
+        'batchSize': batch_size,
+        'inferenceSize': inference_size,
+        'options': options,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', nargs='+', help='Sample clips, a generated video when none are given')
+    parser.add_argument('--frames-per-clip', type=int, default=50)
+    parser.add_argument('--engines', default=','.join(ENGINES), help='Comma-separated engines to compare with eager')
+    parser.add_argument('--export', action='store_true', help='Export the artifacts that are missing instead of skipping their engines')
+    parser.add_argument('--batch-size', type=int, help='Overrides INFERENCE_BATCH_SIZE')
+    parser.add_argument('--inference-size', type=int, help='Overrides INFERENCE_SIZE')
+    parser.add_argument('--score-filter', type=float, default=0.6, help='Boxes scored below this are left out of the comparison')
+    parser.add_argument('--iou', type=float, default=0.5, help='Overlap two boxes need to count as the same detection')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed passes over the frames per engine, the median is reported')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+    args.engines = [engine.strip() for engine in args.engines.split(',') if engine.strip()]
+    unknown_engines = set(args.engines) - set(ENGINES)
+    if unknown_engines:
+        parser.error(f'unknown engines: {", ".join(sorted(unknown_engines))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {key: value for key, value in vars(args).items() if key != 'output'}
+    results = run_benchmark(options)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
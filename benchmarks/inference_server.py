@@ -0,0 +1,37 @@
+"""
+Stand-in model server answering like `app.inference_server`, with the stub model in place of the real one.
+
+It needs neither torch nor the model weights, so the remote inference backend can be tried out and benchmarked anywhere.
+Run from the repository root, then point the app or the video pipeline benchmark at it, e.g.
+
+    python -m benchmarks.inference_server --port 8001 --frame-latency 0.02
+    INFERENCE_BACKEND=remote INFERENCE_FRAME_FORMAT=png python -m benchmarks.video_pipeline --model real
+
+PNG keeps frames lossless, JPEG artifacts around the synthetic boxes can make the stub find extra ones.
+"""
+import argparse
+
+import uvicorn
+
+from app.inference_server import create_app
+from app.server.config.config import MODEL_CLASSES
+from benchmarks.synthetic import StubModel
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--batch-latency', type=float, default=0.0, help='Seconds the stub model sleeps per batch')
+    parser.add_argument('--frame-latency', type=float, default=0.0, help='Seconds the stub model sleeps per frame')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = create_app(StubModel(MODEL_CLASSES, args.batch_latency, args.frame_latency))
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
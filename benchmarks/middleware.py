@@ -0,0 +1,171 @@
+"""
+Compares the exception middleware of the app, a plain ASGI middleware, with the BaseHTTPMiddleware version it replaced.
+
+Requests are sent straight into the ASGI app, without a server or sockets, so the numbers are the cost of the app and
+its middleware alone: a small JSON response, an error mapped to a JSON response and a streamed response, for which
+the time to the first body chunk shows whether the middleware holds it back.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.middleware --requests 5000 --output middleware.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+# Per-request debug logs would dominate the timings, this has to be set before the config is imported
+os.environ.setdefault('LOG_LEVEL', 'INFO')
+
+# pylint: disable=wrong-import-position
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app.server.logger.custom_logger import logging_api_requests
+from app.server.middlewares.exceptions import ExceptionHandlerMiddleware, get_exception_response
+
+PATHS = ('/json', '/error', '/stream')
+
+
+class BaseHTTPExceptionHandlerMiddleware(BaseHTTPMiddleware):
+    """The exception middleware as it was before, on top of BaseHTTPMiddleware, kept as the baseline"""
+
+    async def dispatch(self, request: Request, call_next):
+        start_time = time.time()
+        try:
+            response = await call_next(request)
+            response.headers['X-Process-Time'] = str(time.time() - start_time)
+            logging_api_requests(request, response.status_code)
+        except Exception as error:  # pylint: disable=broad-except
+            response = get_exception_response(error)
+        return response
+
+
+def build_app(middleware_class, chunk_count, chunk_size):
+    app = FastAPI()
+    chunk = b'x' * chunk_size
+
+    @app.get('/json')
+    async def json_route():
+        return {'status': 'SUCCESS', 'data': {}}
+
+    @app.get('/error')
+    async def error_route():
+        raise ValueError('Invalid value')
+
+    @app.get('/stream')
+    async def stream_route():
+        async def chunks():
+            for _ in range(chunk_count):
+                yield chunk
+
+        return StreamingResponse(chunks(), media_type='application/octet-stream')
+
+    app.add_middleware(middleware_class)
+    return app
+
+
+async def send_request(app, path):
+    """Sends one GET request into the app
+
+    Returns:
+        tuple: (seconds to the first body chunk, seconds to the end of the response)
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'host', b'benchmark')],
+        'client': ('127.0.0.1', 50000),
+        'server': ('benchmark', 80),
+    }
+    request_sent = False
+    first_body_time = None
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Like a server, only report a disconnect when the client goes away, which it doesn't here
+        await asyncio.Event().wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal first_body_time
+        if message['type'] == 'http.response.body' and first_body_time is None:
+            first_body_time = time.perf_counter()
+
+    start_time = time.perf_counter()
+    await app(scope, receive, send)
+    end_time = time.perf_counter()
+    return (first_body_time or end_time) - start_time, end_time - start_time
+
+
+async def measure(app, path, requests, concurrency):
+    timings = []
+    start_time = time.perf_counter()
+    for offset in range(0, requests, concurrency):
+        batch = min(concurrency, requests - offset)
+        timings.extend(await asyncio.gather(*(send_request(app, path) for _ in range(batch))))
+    seconds = time.perf_counter() - start_time
+
+    first_body = sorted(timing[0] for timing in timings)
+    total = sorted(timing[1] for timing in timings)
+    return {
+        'requestsPerSecond': requests / seconds,
+        'meanMs': 1000 * statistics.mean(total),
+        'p50Ms': 1000 * total[len(total) // 2],
+        'p99Ms': 1000 * total[min(len(total) - 1, int(len(total) * 0.99))],
+        'firstBodyP50Ms': 1000 * first_body[len(first_body) // 2],
+    }
+
+
+async def run_benchmark(options):
+    variants = {'asgi': ExceptionHandlerMiddleware, 'base_http': BaseHTTPExceptionHandlerMiddleware}
+    results = {}
+    for name, middleware_class in variants.items():
+        app = build_app(middleware_class, options['chunk_count'], options['chunk_size'])
+        results[name] = {}
+        for path in PATHS:
+            await measure(app, path, options['warmup'], options['concurrency'])
+            results[name][path] = await measure(app, path, options['requests'], options['concurrency'])
+            print(f'{name} {path}: {results[name][path]["requestsPerSecond"]:.0f} req/s', file=sys.stderr)
+    return {'options': options, 'results': results}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per route and middleware')
+    parser.add_argument('--warmup', type=int, default=100, help='Requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight at once')
+    parser.add_argument('--chunk-count', type=int, default=64, help='Chunks in the streamed response')
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024, help='Bytes per streamed chunk')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {key: value for key, value in vars(args).items() if key != 'output'}
+    results = asyncio.run(run_benchmark(options))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Synthetic inputs for the benchmarks: generated videos with moving objects and a deterministic stand-in for the model.
+"""
+import time
+
+import cv2
+import numpy as np
+
+# Saturated BGR colours objects are drawn in, the stub model finds them by colour
+OBJECT_COLOURS = [(0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0)]
+# Smallest blob, in pixels, the stub model reports, codec artifacts around the boxes make a few stray saturated pixels
+MIN_OBJECT_AREA = 64
+
+
+def generate_video(output_file, width=1280, height=720, frame_count=300, objects=5, fps=30, seed=0):
+    """Writes a video of boxes bouncing around a textured background
+
+    The same arguments always produce the same frames, so runs on different machines or commits process identical input.
+
+    Args:
+        output_file (str): Path of the video, written as MP4
+        width (int): Frame width
+        height (int): Frame height
+        frame_count (int): Number of frames
+        objects (int): Number of moving boxes
+        fps (float): Frame rate
+        seed (int): Seed of the background texture and the box sizes, positions and velocities
+
+    Returns:
+        str: `output_file`
+    """
+    rng = np.random.default_rng(seed)
+    # Low-contrast noise keeps the encoder and the scene-change check from treating frames as trivially flat
+    background = rng.integers(60, 100, size=(height, width, 3), dtype=np.uint8)
+    sizes = rng.integers(min(width, height) // 12, min(width, height) // 6, size=(objects, 2))
+    positions = rng.uniform(0, 1, size=(objects, 2)) * (np.array([width, height]) - sizes)
+    velocities = rng.uniform(-1, 1, size=(objects, 2)) * min(width, height) / 100
+
+    writer = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    try:
+        for _ in range(frame_count):
+            frame = background.copy()
+            for index, ((x, y), (w, h)) in enumerate(zip(positions.astype(int), sizes)):
+                cv2.rectangle(frame, (x, y), (x + w, y + h), OBJECT_COLOURS[index % len(OBJECT_COLOURS)], -1)
+            writer.write(frame)
+
+            positions += velocities
+            # Bounce off the edges
+            for axis, limit in enumerate((width, height)):
+                out_of_bounds = (positions[:, axis] < 0) | (positions[:, axis] > limit - sizes[:, axis])
+                velocities[out_of_bounds, axis] *= -1
+                positions[:, axis] = np.clip(positions[:, axis], 0, limit - sizes[:, axis])
+    finally:
+        writer.release()
+    return output_file
+
+
+class StubModel:
+    """
+    Deterministic stand-in for an inference backend (`app.server.utils.inference_utils`), returning predictions in the same format.
+
+    It finds the boxes of `generate_video` by thresholding saturated pixels, and can sleep to simulate
+    the cost of a forward pass, so the benchmark measures the pipeline around the model rather than the model itself.
+    """
+
+    def __init__(self, classes, batch_latency=0.0, frame_latency=0.0) -> None:
+        """
+        Args:
+            classes (list): Labels handed out to the boxes, in order
+            batch_latency (float): Seconds every predict call sleeps
+            frame_latency (float): Seconds every predict call sleeps per frame
+        """
+        self.classes = classes
+        self.batch_latency = batch_latency
+        self.frame_latency = frame_latency
+
+    def predict(self, images):
+        # Like detecto, a list is a batch and gets a list of predictions back
+        if not isinstance(images, list):
+            return self.predict([images])[0]
+        time.sleep(self.batch_latency + self.frame_latency * len(images))
+        return [self._predict_image(image) for image in images]
+
+    def _predict_image(self, image):
+        # Background pixels are grey, boxes have at least one channel at 255
+        mask = (image.max(axis=2) > 200).astype(np.uint8)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        # Tiny boxes would also break the CSRT trackers they're handed to
+        objects = stats[1:count][stats[1:count, cv2.CC_STAT_AREA] >= MIN_OBJECT_AREA]
+        boxes, labels = [], []
+        for index, (x, y, w, h, _) in enumerate(objects):
+            boxes.append([x, y, x + w, y + h])
+            labels.append(self.classes[index % len(self.classes)])
+        return labels, np.array(boxes, dtype=np.float32).reshape(-1, 4), np.ones(len(labels), dtype=np.float32)
@@ -0,0 +1,184 @@
+"""
+Benchmarks the detection loops of `app.server.utils.video_utils` end to end: decode, inference, tracking, drawing and encoding.
+
+Every run happens in a fresh process, so model loading, caches and peak memory don't leak between runs, and the
+results are written as JSON that can be compared with an earlier run through `--baseline`.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.video_pipeline --width 1920 --height 1080 --frames 600 --output bench.json
+    python -m benchmarks.video_pipeline --model real --baseline bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import StubModel, generate_video
+
+MODES = ('detector', 'tracker', 'strided')
+
+# Command-line options handed to the app through its environment-based config
+CONFIG_OPTIONS = {'batch_size': 'INFERENCE_BATCH_SIZE', 'inference_size': 'INFERENCE_SIZE', 'encoder': 'ENCODER_BACKEND', 'tracker_threads': 'TRACKER_THREADS'}
+
+
+def run_case(mode, input_file, output_file, options):
+    """Processes the video once with one detection mode, inside a fresh worker process
+
+    Returns:
+        dict: Wall time, fps, per-stage time, peak RSS and output size of the run
+    """
+    # Imported here so the config is read after the parent process has set its environment
+    # pylint: disable=import-outside-toplevel
+    from app.server.config.config import MODEL_CLASSES
+    from app.server.models.parsed_video import DetectionParams
+    from app.server.utils.metrics_utils import stage_seconds
+    from app.server.utils.inference_utils import inference_backend
+    from app.server.utils.video_utils import get_detection_function
+
+    load_seconds = 0.0
+    if options['model'] == 'real':
+        start_time = time.perf_counter()
+        inference_backend.warm_up()
+        load_seconds = time.perf_counter() - start_time
+        model = inference_backend
+    else:
+        model = StubModel(MODEL_CLASSES, options['stub_batch_latency'], options['stub_frame_latency'])
+
+    detect = get_detection_function(DetectionParams(mode=mode, stride=options['stride'], motionThreshold=options['motion_threshold'], motionInterval=options['motion_interval']))
+    start_time = time.perf_counter()
+    stats = detect(input_file, output_file, None, model=model)
+    seconds = time.perf_counter() - start_time
+
+    stages = {}
+    for (stage,), (counts, total) in stage_seconds.values.items():
+        frames = sum(counts)
+        stages[stage] = {'seconds': total, 'frames': frames, 'msPerFrame': 1000 * total / frames if frames else 0}
+
+    return {
+        'mode': mode,
+        'frames': stats.totalFrames,
+        'detectorFrames': stats.detectorFrames,
+        'trackerFrames': stats.trackerFrames,
+        'reusedFrames': stats.reusedFrames,
+        'seconds': seconds,
+        'fps': stats.totalFrames / seconds if seconds else 0,
+        'modelLoadSeconds': load_seconds,
+        'stages': stages,
+        # ru_maxrss is in KiB on Linux; children are the encoder processes
+        'peakRssMb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'encoderPeakRssMb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'outputBytes': os.path.getsize(output_file) if os.path.exists(output_file) else 0,
+    }
+
+
+def run_benchmark(options):
+    """Runs every requested mode `repeat` times and collects the results with the setup they were measured on"""
+    for option, variable in CONFIG_OPTIONS.items():
+        if options.get(option) is not None:
+            os.environ[variable] = str(options[option])
+
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as work_folder:
+        input_file = options['input']
+        if input_file is None:
+            input_file = generate_video(os.path.join(work_folder, 'input.mp4'), options['width'], options['height'], options['frames'], options['objects'], options['fps'], options['seed'])
+
+        cases = []
+        for mode in options['modes']:
+            runs = []
+            for index in range(options['repeat']):
+                output_file = os.path.join(work_folder, f'{mode}_{index}.mp4')
+                # One process per run, so peak RSS belongs to that run alone
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(run_case, (mode, input_file, output_file, options)))
+                print(f'{mode} run {index + 1}/{options["repeat"]}: {runs[-1]["fps"]:.1f} fps', file=sys.stderr)
+            cases.append({'mode': mode, 'medianFps': statistics.median(run['fps'] for run in runs), 'runs': runs})
+
+    return {'meta': get_meta(options), 'cases': cases}
+
+
+def get_meta(options):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'options': options,
+        'config': {variable: os.environ.get(variable) for variable in CONFIG_OPTIONS.values()},
+    }
+
+
+def compare(results, baseline):
+    """Prints the fps change of every mode against a baseline results file"""
+    baseline_fps = {case['mode']: case['medianFps'] for case in baseline['cases']}
+    for case in results['cases']:
+        previous = baseline_fps.get(case['mode'])
+        if not previous:
+            continue
+        change = 100 * (case['medianFps'] - previous) / previous
+        print(f'{case["mode"]}: {previous:.1f} -> {case["medianFps"]:.1f} fps ({change:+.1f}%)', file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', help='Benchmark this video instead of a generated one')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--objects', type=int, default=5)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma-separated detection modes to run')
+    parser.add_argument('--stride', type=int, default=10, help='Detector stride of the strided mode')
+    parser.add_argument('--motion-threshold', type=float, default=0.0, help='Motion gate of the detector mode, 0 detects every frame')
+    parser.add_argument('--motion-interval', type=int, default=30, help='Most frames in a row the motion gate lets reuse boxes')
+    parser.add_argument('--model', choices=('stub', 'real'), default='stub', help='The stub model, or the INFERENCE_BACKEND one: the model at MODEL_PATH or the model server')
+    parser.add_argument('--stub-batch-latency', type=float, default=0.0, help='Seconds the stub model sleeps per batch')
+    parser.add_argument('--stub-frame-latency', type=float, default=0.0, help='Seconds the stub model sleeps per frame')
+    parser.add_argument('--batch-size', type=int, help='Overrides INFERENCE_BATCH_SIZE')
+    parser.add_argument('--inference-size', type=int, help='Overrides INFERENCE_SIZE')
+    parser.add_argument('--encoder', choices=('opencv', 'ffmpeg'), help='Overrides ENCODER_BACKEND')
+    parser.add_argument('--tracker-threads', type=int, help='Overrides TRACKER_THREADS')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per mode, the median fps is reported')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='Earlier JSON results to compare fps with')
+    args = parser.parse_args(argv)
+    args.modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown_modes = set(args.modes) - set(MODES)
+    if unknown_modes:
+        parser.error(f'unknown modes: {", ".join(sorted(unknown_modes))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')}
+    results = run_benchmark(options)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()